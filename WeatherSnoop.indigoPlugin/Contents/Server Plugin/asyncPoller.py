@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# asyncio alternative to pollEngine.PollEngine. Every fetch in a poll cycle runs
+# as a coroutine on one event loop owned by the concurrent thread, so polling
+# many agents doesn't need a thread (and its stack) per request, and a stop
+# request cancels outstanding fetches instead of waiting on blocking sockets.
+
+import asyncio
+import collections
+import logging
+import ssl
+import time
+from urllib import parse
+
+import wsHttp
+
+################################################################################
+# Globals
+################################################################################
+kStopCheckInterval = 0.25   # seconds between checks for a plugin shutdown
+kMaxIdleConnections = 4     # keep-alive connections retained per server
+
+################################################################################
+class AsyncFetchError(Exception):
+    pass
+
+################################################################################
+class AsyncPoller(object):
+    def __init__(self, agentFetcher, maxConcurrent, maxPerServer, shouldStop=None):
+        # Shares the payload tracker, circuit breakers and timeouts of the
+        # requests-based fetcher so both backends behave the same
+        self.logger = logging.getLogger("Plugin.asyncPoller")
+        self.loop = asyncio.new_event_loop()
+        self.agentFetcher = agentFetcher
+        self.payloadTracker = agentFetcher.payloadTracker
+        self.circuitBreakers = agentFetcher.circuitBreakers
+        self.addressCache = agentFetcher.addressCache
+        self.shouldStop = shouldStop
+        self.maxConcurrent = 0
+        self.maxPerServer = 0
+        self.idleConnections = collections.defaultdict(list)  # hostKey -> [(reader, writer)]
+        self.configure(maxConcurrent, maxPerServer)
+
+    ########################################
+    def configure(self, maxConcurrent, maxPerServer):
+        self.maxConcurrent = max(1, int(maxConcurrent))
+        self.maxPerServer = max(1, int(maxPerServer))
+
+    ########################################
+    def fetchAll(self, jobs, deadline=None):
+        # Same contract as PollEngine.fetchAll: yields (key, result, exception) as
+        # each fetch finishes, and DeadlineMissedError for fetches cancelled at the
+        # deadline. Must be called from the thread that owns the poller.
+        globalSlots = asyncio.Semaphore(self.maxConcurrent)
+        serverSlots = {}
+        tasks = {}
+        for key, url in jobs:
+            server = self.serverForUrl(url)
+            if server not in serverSlots:
+                serverSlots[server] = asyncio.Semaphore(self.maxPerServer)
+            task = self.loop.create_task(self.fetchLimited(url, globalSlots, serverSlots[server]))
+            tasks[task] = key
+        pending = set(tasks.keys())
+        stopped = False
+        try:
+            while pending:
+                if self.shouldStop and self.shouldStop():
+                    self.logger.debug("Stop requested, cancelling %i outstanding fetches" % len(pending))
+                    stopped = True
+                    break
+                timeout = kStopCheckInterval
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.time())
+                    if timeout <= 0:
+                        break
+                done, pending = self.loop.run_until_complete(
+                    asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    exc = task.exception()
+                    if exc:
+                        yield tasks[task], None, exc
+                    else:
+                        yield tasks[task], task.result(), None
+            if not stopped:
+                for task in pending:
+                    yield tasks[task], None, wsHttp.DeadlineMissedError("Poll cycle time budget ran out")
+        finally:
+            if pending:
+                for task in pending:
+                    task.cancel()
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    ########################################
+    def serverForUrl(self, url):
+        try:
+            return wsHttp.hostKeyForUrl(url)
+        except ValueError:
+            return ""
+
+    ########################################
+    async def fetchLimited(self, url, globalSlots, serverSlot):
+        async with globalSlots:
+            async with serverSlot:
+                hostKey = wsHttp.hostKeyForUrl(url)
+                self.circuitBreakers.checkServer(hostKey)
+                try:
+                    document = await self.fetchDocument(url)
+                except asyncio.TimeoutError:
+                    self.circuitBreakers.recordFailure(hostKey)
+                    raise TimeoutError("Timed out fetching %s" % url)
+                except (OSError, asyncio.IncompleteReadError):
+                    self.circuitBreakers.recordFailure(hostKey)
+                    raise
+                self.circuitBreakers.recordSuccess(hostKey)
+                return document
+
+    ########################################
+    async def fetchDocument(self, url):
+        parts = parse.urlsplit(url)
+        hostKey = wsHttp.hostKeyForUrl(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        requestLines = ["GET %s HTTP/1.1" % path, "Host: %s" % parts.netloc, "Accept: application/json"]
+        for name, value in self.payloadTracker.requestHeaders(url).items():
+            requestLines.append("%s: %s" % (name, value))
+        request = ("\r\n".join(requestLines) + "\r\n\r\n").encode("latin-1")
+        while True:
+            reader, writer, reused = await self.openConnection(hostKey, parts)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, body = await asyncio.wait_for(self.readResponse(reader), self.agentFetcher.readTimeout)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # The server dropped an idle keep-alive connection - try the next one
+            except BaseException:
+                writer.close()
+                raise
+        if headers.get("connection", "").lower() == "close" or len(self.idleConnections[hostKey]) >= kMaxIdleConnections:
+            writer.close()
+        else:
+            self.idleConnections[hostKey].append((reader, writer))
+        if status >= 400:
+            raise AsyncFetchError("HTTP status %i from %s" % (status, url))
+        return self.payloadTracker.documentForResponse(url, status, headers, body)
+
+    ########################################
+    async def openConnection(self, hostKey, parts):
+        idle = self.idleConnections[hostKey]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        sslContext = ssl.create_default_context() if parts.scheme == "https" else None
+        port = parts.port or (443 if sslContext else 80)
+        # The Host header always carries the name, only the socket uses the
+        # address mDNS gave us
+        address = None if sslContext else self.addressCache.addressFor(parts.hostname)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(address or parts.hostname, port, ssl=sslContext),
+                                                    self.agentFetcher.connectTimeout)
+        except (OSError, asyncio.TimeoutError):
+            if address:
+                # The address may be stale - use the resolver for a while
+                self.addressCache.markFailed(parts.hostname, address)
+            raise
+        return reader, writer, False
+
+    ########################################
+    async def readResponse(self, reader):
+        statusLine = await reader.readuntil(b"\r\n")
+        status = int(statusLine.split(None, 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # Skip any trailers up to the final blank line
+                    while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif status == 304 or status == 204:
+            body = b""
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            # No framing - the body runs to the end of the connection
+            body = await reader.read()
+            headers["connection"] = "close"
+        return status, headers, body
+
+    ########################################
+    def close(self):
+        for connections in self.idleConnections.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idleConnections.clear()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
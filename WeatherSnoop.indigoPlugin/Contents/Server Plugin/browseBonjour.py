@@ -3,65 +3,227 @@ import pybonjour
 import threading
 import re
 import logging
+import time
+import socket
+import collections
+
+kStopCheckInterval = 1.0    # longest we wait in select before checking for a stop request
 
 def replaceChar(matchobj):
     return chr(int(matchobj.group(1)))
 
+class PendingResolve(object):
+    # One outstanding DNSServiceResolve started from the browse callback
+    __slots__ = ("sdRef", "serviceKey", "deadline", "done")
+
+    def __init__(self, serviceKey, deadline):
+        self.sdRef = None
+        self.serviceKey = serviceKey
+        self.deadline = deadline
+        self.done = False
+
 class BonjourBrowserThread(threading.Thread):
-    def __init__(self, logMethod, type, queue, timeout):
+    # Browses for services and resolves every one whose name starts with one of
+    # namePrefixes (all of them if it's empty) - anything else is ignored before
+    # any resolve traffic. All resolves are kept in the same select set as the
+    # browse, each with its own timeout, so a responder that never answers
+    # doesn't hold up the others. When the DNS-SD library supports it the
+    # browse and every resolve share one connection to the daemon, so there's
+    # a single socket to watch however many services are resolving. Given an
+    # addressCache (wsHttp.AddressCache) the host of every resolved service is
+    # also watched for A/AAAA records and its addresses kept in the cache.
+    # The same service can be found on several interfaces, so each (name,
+    # host, port) is reference counted: the queue gets an add when the first
+    # of them resolves and a delete when the last one goes away.
+    def __init__(self, logMethod, type, queue, timeout, namePrefixes=(), addressCache=None):
         threading.Thread.__init__(self)
+        self.namePrefixes = tuple(namePrefixes)
+        self.addressCache = addressCache
+        self.addressQueries = {}    # host -> [services using it, query sdRefs]
         self.logger = logging.getLogger("Plugin.browseBonjour")
         self.regtype	 = type
         self.timeout	 = timeout
-        self.resolved = []
+        self.connection = None
+        self.pendingResolves = []
+        self.resolvedServices = {}  # (interfaceIndex, serviceName, regtype, domain) -> (name, host, port)
+        self.instanceCounts = collections.Counter()    # (name, host, port) -> services resolved to it
         self.shouldContinue = True
         self.commandQueue = queue
 
-    def resolve_callback(self, sdRef, flags, interfaceIndex, errorCode, fullname, hosttarget, port, txtRecord):
+    def resolve_callback(self, pending, flags, interfaceIndex, errorCode, fullname, hosttarget, port, txtRecord):
         p = re.compile(r"\\([0-9][0-9][0-9])")
         fixedName = p.sub(replaceChar, fullname)
         fixedName = fixedName.replace("\\","")
         correctFullName = fixedName.split("."+self.regtype)[0]
         self.logger.threaddebug(u"__resolve_callback called with interfaceIndex: %s, fullname: %s, hosttarget: %s, port: %s" % (str(interfaceIndex), correctFullName, hosttarget, str(port)))
         if errorCode == pybonjour.kDNSServiceErr_NoError:
+            instance = (correctFullName, hosttarget, port)
+            previous = self.resolvedServices.get(pending.serviceKey, None)
+            if previous != instance:
+                # Take the new host before letting go of the old one, which
+                # may well be the same host on a different port
+                self.resolvedServices[pending.serviceKey] = instance
+                self.addInstance(instance)
+                self.watchHost(hosttarget, interfaceIndex)
+                if previous:
+                    self.removeInstance(previous)
+                    self.unwatchHost(previous[1])
+        pending.done = True
+
+    def addInstance(self, instance):
+        self.instanceCounts[instance] += 1
+        if self.instanceCounts[instance] == 1:
             self.logger.threaddebug("__adding to queue")
-            self.commandQueue.put(("add", correctFullName, hosttarget, port))
-            self.resolved.append(True)
+            self.commandQueue.put(("add",) + instance)
+
+    def removeInstance(self, instance):
+        self.instanceCounts[instance] -= 1
+        if self.instanceCounts[instance] <= 0:
+            del self.instanceCounts[instance]
+            self.logger.threaddebug("__removing from queue")
+            self.commandQueue.put(("delete",) + instance)
 
     def browse_callback(self, sdRef, flags, interfaceIndex, errorCode, serviceName, regtype, replyDomain):
         self.logger.threaddebug("__browse_callback called")
         if errorCode != pybonjour.kDNSServiceErr_NoError:
             return
+        if self.namePrefixes and not serviceName.startswith(self.namePrefixes):
+            return
+        serviceKey = (interfaceIndex, serviceName, regtype, replyDomain)
         if not (flags & pybonjour.kDNSServiceFlagsAdd):
-            self.commandQueue.put(("delete", serviceName))
+            # Report the removal the same way the service was added so the
+            # plugin can find it, and drop any resolve still waiting for it
+            for pending in self.pendingResolves:
+                if pending.serviceKey == serviceKey:
+                    pending.done = True
+            resolved = self.resolvedServices.pop(serviceKey, None)
+            if resolved:
+                self.removeInstance(resolved)
+                self.unwatchHost(resolved[1])
             return
         self.logger.threaddebug("__callback called with: %s.%s" % (serviceName, replyDomain))
-        resolve_sdRef = pybonjour.DNSServiceResolve(0, interfaceIndex, serviceName, regtype, replyDomain, self.resolve_callback)
+        pending = PendingResolve(serviceKey, time.time() + self.timeout)
+        callBack = lambda sdRef, *args: self.resolve_callback(pending, *args)
+        pending.sdRef = pybonjour.DNSServiceResolve(0, interfaceIndex, serviceName, regtype, replyDomain, callBack, connection=self.connection)
+        self.pendingResolves.append(pending)
+
+    def watchHost(self, host, interfaceIndex):
+        if self.addressCache is None:
+            return
+        watch = self.addressQueries.get(host, None)
+        if watch:
+            watch[0] += 1
+            return
+        watch = [1, []]
+        self.addressQueries[host] = watch
+        callBack = lambda sdRef, *args: self.query_callback(host, *args)
+        for rrtype in (pybonjour.kDNSServiceType_A, pybonjour.kDNSServiceType_AAAA):
+            try:
+                watch[1].append(pybonjour.DNSServiceQueryRecord(interfaceIndex = interfaceIndex, fullname = host, rrtype = rrtype,
+                                                                 callBack = callBack, connection = self.connection))
+            except pybonjour.BonjourError as e:
+                self.logger.threaddebug("__couldn't watch addresses of %s: %s" % (host, str(e)))
+
+    def unwatchHost(self, host):
+        watch = self.addressQueries.get(host, None)
+        if not watch:
+            return
+        watch[0] -= 1
+        if watch[0] <= 0:
+            del self.addressQueries[host]
+            for sdRef in watch[1]:
+                sdRef.close()
+            self.addressCache.release(host)
+
+    def query_callback(self, host, flags, interfaceIndex, errorCode, fullname, rrtype, rrclass, rdata, ttl):
+        if errorCode != pybonjour.kDNSServiceErr_NoError:
+            return
+        family = socket.AF_INET if rrtype == pybonjour.kDNSServiceType_A else socket.AF_INET6
         try:
-            while not self.resolved:
-                ready = select.select([resolve_sdRef], [], [], self.timeout)
-                if resolve_sdRef not in ready[0]:
-                    break
-                pybonjour.DNSServiceProcessResult(resolve_sdRef)
+            address = socket.inet_ntop(family, rdata)
+        except (ValueError, OSError):
+            return
+        if family == socket.AF_INET6 and address.lower().startswith("fe80:"):
+            # Link-local addresses need an interface scope to be usable
+            return
+        self.logger.threaddebug("__address %s %s for %s (ttl %s)" % ("added" if flags & pybonjour.kDNSServiceFlagsAdd else "removed", address, host, ttl))
+        if flags & pybonjour.kDNSServiceFlagsAdd:
+            self.addressCache.add(host, address, ttl)
+        else:
+            self.addressCache.remove(host, address)
+
+    def finishResolves(self):
+        now = time.time()
+        remaining = []
+        for pending in self.pendingResolves:
+            if pending.done or pending.deadline <= now:
+                if not pending.done:
+                    self.logger.threaddebug("__resolve timed out for %s" % pending.serviceKey[1])
+                pending.sdRef.close()
             else:
-                self.resolved.pop()
-        finally:
-            resolve_sdRef.close()
+                remaining.append(pending)
+        self.pendingResolves = remaining
+
+    def startBrowse(self):
+        try:
+            self.connection = pybonjour.DNSServiceCreateConnection()
+            return pybonjour.DNSServiceBrowse(regtype = self.regtype, callBack = self.browse_callback, connection = self.connection)
+        except pybonjour.BonjourError as e:
+            # Avahi's compatibility library, for one, can't share connections
+            self.logger.threaddebug("__shared connection unavailable, using one per operation: %s" % str(e))
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            return pybonjour.DNSServiceBrowse(regtype = self.regtype, callBack = self.browse_callback)
 
     def stopThread(self):
         self.shouldContinue = False
 
     def run(self):
         self.logger.threaddebug("__starting browser thread")
+        browse_sdRef = None
         try:
-            browse_sdRef = pybonjour.DNSServiceBrowse(regtype = self.regtype, callBack = self.browse_callback)
+            browse_sdRef = self.startBrowse()
             while self.shouldContinue:
-                ready = select.select([browse_sdRef], [], [])
-                if browse_sdRef in ready[0]:
-                    self.logger.threaddebug("__found a service")
-                    pybonjour.DNSServiceProcessResult(browse_sdRef)
-        except (Exception, e):
-            self.logger.threaddebug("__exception in bonjour browser thread: %s", str(e))
-            pass
+                wait = kStopCheckInterval
+                if self.pendingResolves:
+                    wait = min(wait, max(0, min(pending.deadline for pending in self.pendingResolves) - time.time()))
+                if self.connection is not None:
+                    refs = [self.connection]
+                else:
+                    refs = [browse_sdRef] + [pending.sdRef for pending in self.pendingResolves]
+                    refs.extend(sdRef for watch in self.addressQueries.values() for sdRef in watch[1])
+                ready = select.select(refs, [], [], wait)[0]
+                for sdRef in ready:
+                    if not sdRef._valid():
+                        # Closed by a callback earlier in this round (unwatchHost)
+                        continue
+                    if sdRef is browse_sdRef or sdRef is self.connection:
+                        self.logger.threaddebug("__reply from the daemon")
+                        pybonjour.DNSServiceProcessResult(sdRef)
+                        continue
+                    try:
+                        pybonjour.DNSServiceProcessResult(sdRef)
+                    except pybonjour.BonjourError as e:
+                        # Give up on this service (or address query) only
+                        self.logger.threaddebug("__resolve or query failed: %s" % str(e))
+                        for pending in self.pendingResolves:
+                            if pending.sdRef is sdRef:
+                                pending.done = True
+                self.finishResolves()
+        except Exception as e:
+            self.logger.threaddebug("__exception in bonjour browser thread: %s" % str(e))
         finally:
-            browse_sdRef.close()
\ No newline at end of file
+            # Operations on a shared connection have to be closed before it is
+            for pending in self.pendingResolves:
+                pending.sdRef.close()
+            self.pendingResolves = []
+            for host in list(self.addressQueries):
+                for sdRef in self.addressQueries.pop(host)[1]:
+                    sdRef.close()
+                self.addressCache.release(host)
+            if browse_sdRef is not None:
+                browse_sdRef.close()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -20,15 +20,26 @@ try:
 except:
     import simplejson as json
 
-import requests
 from urllib import parse
 from xml.dom.minidom import parseString
 from datetime import datetime
 import time
-import queue
 import browseBonjour
+import wsHttp
+import pollEngine
+import asyncPoller
+import pushListener
+import stateFilter
+import statePlan
+import siteCache
+import warmCache
+import os
+from concurrent import futures
 import traceback
+import threading
+import ipaddress
 import re
+import collections
 
 ################################################################################
 # Globals
@@ -39,44 +50,32 @@ kWeatherSnoop3String = u"WeatherSnoop 3"
 kWeatherSnoop4String = u"WeatherSnoop 4"
 kWeatherSnoop5String = u"WeatherSnoop 5"
 kFluentWeatherString = u"Fluent Weather"
+kDefaultBonjourNamePrefixes = (kWeatherSnoop3String, kWeatherSnoop4String, kWeatherSnoop5String, kFluentWeatherString)
 kUnavailableString = u"unavailable"
+kPollBackendThreads = "threads"
+kPollBackendAsyncio = "asyncio"
+kPollBackendSerial = "serial"
+kDefaultPollInterval = 30
+kDefaultMinPollInterval = 5
+kDefaultMaxPollInterval = 600
+kDefaultPollCycleBudget = 15    # seconds a poll cycle may spend waiting on agents
+kDeferredPollDelay = 1          # retry delay for devices that missed a cycle's deadline
+kLoopErrorDelay = 5             # pause after an unexpected error in the concurrent thread's loop
+kWarmUpPriorityCold = 0         # devices with nothing to show yet are refreshed first
+kWarmUpPriorityWarm = 1         # then ones that started from the startup cache
+kAgentListBudget = 5            # seconds the config dialog waits for site details
+kAgentListMemoTtl = 30          # seconds an agent list is reused across dialog reloads
+kDefaultPrefetchTtl = 600       # seconds before agents prefetched from a discovered server are refreshed
 
 ########################################
 # Plugin shared methods
 ########################################
-def getWindDirectionCardinal(windDirectionDegrees):
-    windCardinal = ("N","North")
-    if windDirectionDegrees in range(11,33):
-        windCardinal = ("NNE","North Northeast")
-    elif windDirectionDegrees in range(34,55):
-        windCardinal = ("NE","Northeast")
-    elif windDirectionDegrees in range(56,78):
-        windCardinal = ("ENE","East Northeast")
-    elif windDirectionDegrees in range(79,100):
-        windCardinal = ("E","East")
-    elif windDirectionDegrees in range(101,123):
-        windCardinal = ("ESE","East Southeast")
-    elif windDirectionDegrees in range(124,145):
-        windCardinal = ("SE","Southeast")
-    elif windDirectionDegrees in range(146,168):
-        windCardinal = ("SSE","South Southeast")
-    elif windDirectionDegrees in range(169,190):
-        windCardinal = ("S","South")
-    elif windDirectionDegrees in range(191,213):
-        windCardinal = ("SSW","South Southwest")
-    elif windDirectionDegrees in range(214,235):
-        windCardinal = ("SW","Southwest")
-    elif windDirectionDegrees in range(236,258):
-        windCardinal = ("WSW","West Southwest")
-    elif windDirectionDegrees in range(259,280):
-        windCardinal = ("W","West")
-    elif windDirectionDegrees in range(281,303):
-        windCardinal = ("WNW","West Northwest")
-    elif windDirectionDegrees in range(304,325):
-        windCardinal = ("NW","Northwest")
-    elif windDirectionDegrees in range(326,348):
-        windCardinal = ("NNW","North Northwest")
-    return windCardinal
+def schemaFingerprint(properties):
+    # Everything buildDynamicDeviceStates looks at - property ids, names and each
+    # value's unit, label and type - but none of the readings themselves. The
+    # tuple itself rather than its hash, so two schemas never share a plan.
+    return tuple((property, valueDict["name"], tuple((value.get("unit", None), value.get("label", None), value.get("type", None)) for value in valueDict["values"]))
+                 for property, valueDict in properties.items())
 
 def isValidHostname(hostname):
     if len(hostname) > 255 or len(hostname) < 1:
@@ -95,14 +94,55 @@ class Plugin(indigo.PluginBase):
     ########################################
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
+        self.startTime = time.time()
+        self.wakeup = pollEngine.Wakeup()  # cuts the concurrent thread's wait short when there's work
         self.debug = pluginPrefs.get("showDebugInfo", False)
         self.deviceList = []
         self.localWsServers = {}
-        self.bonjourBrowserCommandQueue = queue.Queue()
-        self.bonjourBrowser = browseBonjour.BonjourBrowserThread(self.logger.debug, kServiceType, self.bonjourBrowserCommandQueue, kTimeout)
-        self.bonjourBrowser.start()
-        self.siteFieldCache = {}
-        self.deviceStateCache = {}
+        self.siteFieldCache = siteCache.SiteCache()    # agent URI -> agent properties seen by the config dialog
+        self.agentListCache = siteCache.SiteCache(ttl=kAgentListMemoTtl)   # server -> (agent menu items, last site name, {agent URI: properties})
+        self.prefetchExecutor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="wsPrefetch")
+        self.prefetchDue = {}   # server -> time its agents should next be prefetched
+        self.deviceStateCache = {}  # deviceId -> {stateKey: (value, uiValue, decimalPlaces)} last pushed to the server
+        self.agentFetcher = wsHttp.AgentFetcher(pluginPrefs.get("connectTimeout", wsHttp.kConnectTimeout),
+                                                pluginPrefs.get("readTimeout", wsHttp.kReadTimeout))
+        self.pollCycleBudget = int(pluginPrefs.get("pollCycleBudget", kDefaultPollCycleBudget))
+        self.bonjourBrowserCommandQueue = pollEngine.WakeupQueue(self.wakeup)
+        self.bonjourNamePrefixes = self.parseNamePrefixes(pluginPrefs.get("bonjourNamePrefixes", ""))
+        # Set by the prefs dialog, applied by the concurrent thread which owns localWsServers
+        self.requestedNamePrefixes = self.bonjourNamePrefixes
+        self.bonjourBrowser = None
+        self.startBonjourBrowser()
+        self.appliedPayloads = {}   # deviceId -> token of the agent payload last applied
+        self.deadbandHeldBack = set()   # deviceIds with readings the deadband filter is holding back
+        self.deviceCounters = collections.defaultdict(collections.Counter)  # deviceId -> polls, timeouts, deadlineMisses
+        self.pollEngine = pollEngine.PollEngine(self.agentFetcher.fetchDocument,
+                                                pluginPrefs.get("maxConcurrentRequests", pollEngine.kMaxConcurrentRequests),
+                                                pluginPrefs.get("maxRequestsPerServer", pollEngine.kMaxRequestsPerServer))
+        # Created on the concurrent thread the first time the asyncio backend is selected
+        self.asyncPoller = None
+        # The config dialog and the prefetch worker can't drive the concurrent
+        # thread's event loop, so with the asyncio backend they share a second
+        # poller, one caller at a time
+        self.agentListPoller = None
+        self.agentListLock = threading.Lock()
+        self.pollScheduler = pollEngine.PollScheduler()
+        self.deadbandFilter = stateFilter.DeadbandFilter()
+        try:
+            self.deadbandFilter.configure(stateFilter.parseDeadbandRules(pluginPrefs.get("deadbandRules", "")))
+        except ValueError as exc:
+            self.logger.error("Ignoring deadband rules: %s" % exc)
+        self.pushQueue = pollEngine.WakeupQueue(self.wakeup)
+        self.pushListener = None
+        self.startPushListener(pluginPrefs)
+        self.adaptiveIntervals = pollEngine.AdaptiveIntervals()
+        self.lastAgentProperties = {}   # deviceId -> agent properties seen on the last poll
+        self.schemaFingerprints = {}    # deviceId -> schemaFingerprint of the properties its dynamic states match
+        self.statePlans = {}            # schemaFingerprint -> statePlan.StatePlan
+        self.warmCache = warmCache.WarmCache(os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+                                                          "%s.startupCache.json" % pluginId))
+        self.warmCache.load()
+        self.warmUpQueue = pollEngine.WakeupPriorityQueue(self.wakeup)  # (kWarmUpPriority*, deviceId) waiting for their first refresh
 
     ########################################
     def deviceStartComm(self, device):
@@ -112,20 +152,35 @@ class Plugin(indigo.PluginBase):
         # in pluginProps with the new ones then delete them from the cache.
         # We could avoid this if we could write arbitrary plugin props from
         # within the dialog methods.
-        if device.deviceTypeId == "ws3station" and (device.pluginProps["wsAgent"] in self.siteFieldCache):
+        siteProps = self.siteFieldCache.pop(device.pluginProps["wsAgent"], None) if device.deviceTypeId == "ws3station" else None
+        if siteProps is not None:
             props = device.pluginProps
-            props["dynamicStates"] = self.buildDynamicDeviceStates(self.siteFieldCache[props["wsAgent"]])
+            props["dynamicStates"] = self.buildDynamicDeviceStates(siteProps)
             device.replacePluginPropsOnServer(props)
             # TODO: if we want to be clever we could attempt to guess from the "displayState" property
             # what kind of icon to show. By default we'll just show temp sensor (see last line of method).
             device.stateListOrDisplayStateIdChanged()
-            del self.siteFieldCache[props["wsAgent"]]
             self.logger.debug("  self.siteFieldCache:\n%s" % self.siteFieldCache.keys())
+        self.appliedPayloads.pop(device.id, None)
+        self.deadbandHeldBack.discard(device.id)
+        self.lastAgentProperties.pop(device.id, None)
+        self.deviceStateCache.pop(device.id, None)
+        self.schemaFingerprints.pop(device.id, None)
+        if device.deviceTypeId == "ws3station" and "pollInterval" not in device.states:
+            # Devices created before the pollInterval state existed need their state list refreshed
+            device.stateListOrDisplayStateIdChanged()
         if device.id not in self.deviceList:
-            # we added the soil temp so if the current device doesn't have one
-            # force it to reload the states
-            self.update(device)
+            # No network here - the first real refresh is queued for the concurrent
+            # thread so Indigo isn't kept waiting on agents that are slow or down
+            startTime = time.time()
+            cachedDocument = self.warmCache.documentFor(device.id, device.pluginProps.get("wsAgent", ""))
+            if cachedDocument is not None:
+                # Come up with the readings from the last run
+                self.updateFromAgentDocument(device, cachedDocument)
             self.deviceList.append(device.id)
+            self.warmUpQueue.put((kWarmUpPriorityWarm if cachedDocument is not None else kWarmUpPriorityCold, device.id))
+            self.logger.debug("Started %s in %.3f seconds (%s)" % (device.name, time.time() - startTime,
+                                                                  "from the startup cache" if cachedDocument is not None else "refresh queued"))
             # and also force the right device state icon to show:
             if device.deviceTypeId == "station" or device.deviceTypeId == "ws3station":
                 device.updateStateImageOnServer(indigo.kStateImageSel.TemperatureSensor)
@@ -135,6 +190,19 @@ class Plugin(indigo.PluginBase):
         self.logger.debug("Stopping device: " + device.name)
         if device.id in self.deviceList:
             self.deviceList.remove(device.id)
+        self.pollScheduler.unschedule(device.id)
+        self.adaptiveIntervals.forget(device.id)
+        self.appliedPayloads.pop(device.id, None)
+        self.deadbandHeldBack.discard(device.id)
+        self.lastAgentProperties.pop(device.id, None)
+        self.deviceStateCache.pop(device.id, None)
+        self.deadbandFilter.forget(device.id)
+        self.schemaFingerprints.pop(device.id, None)
+        wsAgent = device.pluginProps.get("wsAgent", "")
+        if wsAgent and not any(indigo.devices[deviceId].pluginProps.get("wsAgent", "") == wsAgent
+                               for deviceId in self.deviceList if deviceId in indigo.devices):
+            # No other device polls this agent, so drop its validators and last document
+            self.agentFetcher.payloadTracker.forget(wsAgent)
 
     ########################################
     def buildDynamicDeviceStates(self, properties):
@@ -207,7 +275,8 @@ class Plugin(indigo.PluginBase):
     def getWSList(self, filter="", valuesDict=None, typeId="", targetId=0):
 #	self.logger.debug("getWSList valuesDict: %s" % str(valuesDict))
         itemList = []
-        for server, url in self.localWsServers.items():
+        # A copy, the concurrent thread may be updating the list
+        for server, url in list(self.localWsServers.items()):
             itemList.append((server, server))
         if len(itemList) == 0:
             itemList.append(("none", "- no weathersnoop servers available -"))
@@ -240,42 +309,99 @@ class Plugin(indigo.PluginBase):
             server = self.localWsServers.get(valuesDict.get("wsInstance", None), None)
 # 		self.logger.debug("server: %s" % server)
         if server:
-            url = "http://{}/api/v1/sites.json".format(server)
-            try:
-                self.logger.debug("url: %s" % url)
-                reply = requests.get(url, timeout=5)
-                sitesDict = reply.json()
-                self.logger.debug("sitesDict: %s" % sitesDict)
-                for siteDict in sitesDict["sites"]:
-                    uri = ""
-                    try:
-                        uri = siteDict["uri"]
-                        self.logger.debug("uri for site: %s" % uri)
-                        # In WeatherSnoop 3.1.5, they dropped the "https://hostname:port" part of the URIs for some reason
-                        # so we need to check to see if the URI start with a / and prepend the protocol/host/port part
-                        if uri.startswith("/"):
-                            uri = "http://{}{}".format(server, uri)
-                            self.logger.debug("new uri: {}".format(uri))
-                        siteInformation = self.getWs3SiteData(uri)
-                        # WS4 change: siteInformation["agent"]["site"]["name"]
-                        name = siteInformation["agent"]["site"]["name"]
-                        valuesDict["siteName"] = name
-                        props = siteInformation["agent"]["properties"]
-                        if "name" in siteDict:
-                            agent = siteDict["name"]
-                        else:
-                            agent = siteDict["agentName"]
-                        itemList.append((uri, "%s (%s)" % (name, agent)))
-                        self.siteFieldCache[uri] = props
-                    except Exception as exc:
-                        self.logger.error("Couldn't get information for site - check WeatherSnoop for issues: %s" % uri)
-                        self.logger.error("Exception: %s" % exc)
-            except (Exception, e):
-                self.logger.exception("Error getting site information from WeatherSnoop. Make sure that you have a valid IP:Port specified and that WeatherSnoop 3 is running.")
+            cachedList = self.agentListCache.get(server, None)
+            if cachedList is not None:
+                itemList, valuesDict["siteName"], siteProps = cachedList
+                itemList = list(itemList)
+                # deviceStartComm takes the properties out of siteFieldCache, so
+                # another device on the same agent needs them put back
+                for uri, props in siteProps.items():
+                    self.siteFieldCache.put(uri, props)
+            else:
+                itemList = self.fetchAgentList(server, valuesDict)
         if len(itemList) == 0:
             itemList.append(("none", "- no agents available -"))
         return itemList
 
+    ########################################
+    def fetchAgentList(self, server, valuesDict, ttl=None):
+        # Get sites.json, then every site's details in parallel, through the
+        # backend the devices are polled with. Sites that haven't answered by
+        # the deadline are left out of this list. ttl overrides how long the
+        # results stay cached.
+        if self.pluginPrefs.get("pollBackend", kPollBackendThreads) != kPollBackendAsyncio:
+            return self.fetchAgentListWith(self.pollEngine, server, valuesDict, ttl)
+        with self.agentListLock:
+            if not self.agentListPoller:
+                self.agentListPoller = asyncPoller.AsyncPoller(self.agentFetcher,
+                                                               self.pluginPrefs.get("maxConcurrentRequests", pollEngine.kMaxConcurrentRequests),
+                                                               self.pluginPrefs.get("maxRequestsPerServer", pollEngine.kMaxRequestsPerServer),
+                                                               shouldStop=lambda: self.stopThread)
+            return self.fetchAgentListWith(self.agentListPoller, server, valuesDict, ttl)
+
+    ########################################
+    def fetchAgentListWith(self, poller, server, valuesDict, ttl):
+        itemList = []
+        url = "http://{}/api/v1/sites.json".format(server)
+        try:
+            self.logger.debug("url: %s" % url)
+            sitesDict = {"sites": []}     # if a stop request cancels the fetch
+            for _, document, exc in poller.fetchAll([(url, url)]):
+                if exc:
+                    raise exc
+                sitesDict = document.data
+            self.logger.debug("sitesDict: %s" % sitesDict)
+            siteDicts = {}
+            for siteDict in sitesDict["sites"]:
+                if "uri" not in siteDict:
+                    self.logger.error("Couldn't get information for site - check WeatherSnoop for issues: %s" % siteDict)
+                    continue
+                uri = siteDict["uri"]
+                self.logger.debug("uri for site: %s" % uri)
+                # In WeatherSnoop 3.1.5, they dropped the "https://hostname:port" part of the URIs for some reason
+                # so we need to check to see if the URI start with a / and prepend the protocol/host/port part
+                if uri.startswith("/"):
+                    uri = "http://{}{}".format(server, uri)
+                    self.logger.debug("new uri: {}".format(uri))
+                siteDicts[uri] = siteDict
+        except Exception:
+            self.logger.exception("Error getting site information from WeatherSnoop. Make sure that you have a valid IP:Port specified and that WeatherSnoop 3 is running.")
+            return itemList
+        items = {}
+        siteProps = {}
+        complete = True
+        jobs = [(uri, uri) for uri in siteDicts]
+        for uri, document, exc in poller.fetchAll(jobs, time.time() + kAgentListBudget):
+            if isinstance(exc, wsHttp.DeadlineMissedError):
+                self.logger.warning("Site %s didn't answer in time - reopen the menu to try again" % uri)
+                complete = False
+                continue
+            try:
+                if exc:
+                    raise exc
+                siteInformation = document.data
+                # WS4 change: siteInformation["agent"]["site"]["name"]
+                name = siteInformation["agent"]["site"]["name"]
+                valuesDict["siteName"] = name
+                props = siteInformation["agent"]["properties"]
+                siteDict = siteDicts[uri]
+                if "name" in siteDict:
+                    agent = siteDict["name"]
+                else:
+                    agent = siteDict["agentName"]
+                items[uri] = "%s (%s)" % (name, agent)
+                siteProps[uri] = props
+                self.siteFieldCache.put(uri, props, ttl)
+            except Exception as exc:
+                self.logger.error("Couldn't get information for site - check WeatherSnoop for issues: %s" % uri)
+                self.logger.error("Exception: %s" % exc)
+                complete = False
+        # Keep the order WeatherSnoop lists the sites in
+        itemList = [(uri, items[uri]) for uri in siteDicts if uri in items]
+        if complete and itemList:
+            self.agentListCache.put(server, (tuple(itemList), valuesDict["siteName"], siteProps), ttl)
+        return itemList
+
     ########################################
     def getStateList(self, filter="", valuesDict=None, typeId="", targetId=0):
         self.logger.debug("getStateList targetId: %s" % targetId)
@@ -283,7 +409,7 @@ class Plugin(indigo.PluginBase):
         itemList = [("none", "- no states available -")]
         if "wsAgent" in valuesDict:
             props = self.siteFieldCache.get(valuesDict["wsAgent"], None)
-            self.logger.debug("getStateList siteFieldCache: %s" % self.siteFieldCache)
+            self.logger.debug("getStateList siteFieldCache: %s" % self.siteFieldCache.keys())
             if not props:
                 try:
                     siteInformation = self.getWs3SiteData(valuesDict["wsAgent"])
@@ -315,6 +441,8 @@ class Plugin(indigo.PluginBase):
         self.logger.debug("scanForAgents called: %s" % valuesDict)
         if valuesDict["wsInstance"] == "" and not valuesDict["manual"]:
             self.logger.error("No valid WeatherSnoop instance selected")
+        # An explicit scan always goes back to the servers
+        self.agentListCache.clear()
 
     ########################################
     # Prefs dialog methods
@@ -329,57 +457,399 @@ class Plugin(indigo.PluginBase):
                 indigo.server.log("Debug logging enabled")
             else:
                 indigo.server.log("Debug logging disabled")
+            self.pollEngine.configure(valuesDict["maxConcurrentRequests"], valuesDict["maxRequestsPerServer"])
+            self.agentFetcher.configure(valuesDict["connectTimeout"], valuesDict["readTimeout"])
+            self.pollCycleBudget = int(valuesDict["pollCycleBudget"])
+            self.stopPushListener()
+            self.startPushListener(valuesDict)
+            self.deadbandFilter.configure(stateFilter.parseDeadbandRules(valuesDict.get("deadbandRules", "")))
+            self.requestedNamePrefixes = self.parseNamePrefixes(valuesDict.get("bonjourNamePrefixes", ""))
+            if self.asyncPoller:
+                self.asyncPoller.configure(valuesDict["maxConcurrentRequests"], valuesDict["maxRequestsPerServer"])
+            with self.agentListLock:
+                if self.agentListPoller:
+                    self.agentListPoller.configure(valuesDict["maxConcurrentRequests"], valuesDict["maxRequestsPerServer"])
+            # Let the concurrent thread pick up prefix and prefetch changes straight away
+            self.wakeup.set()
+
+    ########################################
+    def parseNamePrefixes(self, text):
+        namePrefixes = tuple(prefix.strip() for prefix in text.split(",") if prefix.strip())
+        return namePrefixes or kDefaultBonjourNamePrefixes
+
+    ########################################
+    def startBonjourBrowser(self):
+        # The browser feeds mDNS addresses into the fetcher's address cache
+        self.bonjourBrowser = browseBonjour.BonjourBrowserThread(self.logger.debug, kServiceType, self.bonjourBrowserCommandQueue, kTimeout,
+                                                                 self.bonjourNamePrefixes, self.agentFetcher.addressCache)
+        self.bonjourBrowser.start()
+
+    ########################################
+    def validatePrefsConfigUi(self, valuesDict):
+        errorsDict = indigo.Dict()
+        for key in ("maxConcurrentRequests", "maxRequestsPerServer", "connectTimeout", "readTimeout", "pollCycleBudget", "prefetchTtl"):
+            try:
+                if int(valuesDict.get(key, "")) < 1:
+                    errorsDict[key] = "Enter a whole number of 1 or more."
+            except:
+                errorsDict[key] = "Enter a whole number of 1 or more."
+        try:
+            stateFilter.parseDeadbandRules(valuesDict.get("deadbandRules", ""))
+        except ValueError as exc:
+            errorsDict["deadbandRules"] = str(exc)
+        if valuesDict.get("enablePushListener", False):
+            try:
+                if int(valuesDict.get("pushListenerPort", "")) > 65535 or int(valuesDict.get("pushListenerPort", "")) < 1:
+                    errorsDict["pushListenerPort"] = "Invalid port number specified"
+            except:
+                errorsDict["pushListenerPort"] = "Invalid port number specified"
+            try:
+                ipaddress.IPv4Address(valuesDict.get("pushListenerAddress", "").strip() or pushListener.kDefaultPushAddress)
+            except ValueError:
+                errorsDict["pushListenerAddress"] = "Enter an IPv4 address, 127.0.0.1 for this Mac only or 0.0.0.0 for every interface."
+        if len(errorsDict) > 0:
+            return (False, valuesDict, errorsDict)
+        return (True, valuesDict)
 
     ########################################
     def runConcurrentThread(self):
         self.logger.debug("Starting concurrent tread")
-        self.lastCheck = int(time.time())
+        self.logger.debug("Plugin and %i devices started in %.2f seconds" % (len(self.deviceList), time.time() - self.startTime))
         try:
             while True:
+                if self.stopThread:
+                    raise self.StopThread
+                # Anything queued from here on wakes the wait at the bottom of the loop
+                self.wakeup.clear()
                 try:
-                    # Check the dns queue to see if we need to update our server list
-                    while not self.bonjourBrowserCommandQueue.empty():
-                        command = self.bonjourBrowserCommandQueue.get()
-                        self.logger.debug("command: %s" % command)
-                        # WS4: look for either the WS3 or WS4 string in the bonjour broadcast
-                        if command[1].startswith(kWeatherSnoop3String) or command[1].startswith(kWeatherSnoop4String) or command[1].startswith(kWeatherSnoop5String) or command[1].startswith(kFluentWeatherString):
-                            instanceKey = "%s@%s:%s" % (command[1], command[2], command[3])
-                            if command[0] == "add":
-                                self.localWsServers[instanceKey] = "%s:%s" % (command[2], command[3])
-                                self.logger.debug("Server list: %s" % self.localWsServers)
-                            else:
-                                del self.localWsServers[instanceKey]
-                                self.logger.debug("Server list: %s" % self.localWsServers)
-                except:
-                    pass
-                self.sleep(2)
-                if (int(time.time()) - self.lastCheck) > 30:
-                    # now we cycle through each station
-                    for deviceId in self.deviceList:
-                        # call the update method with the device instance
-                        self.update(indigo.devices[deviceId])
-                    self.lastCheck = int(time.time())
+                    delay = self.runLoopOnce()
+                except self.StopThread:
+                    raise
+                except Exception:
+                    # One bad device, document or cache write mustn't stop polling,
+                    # discovery and pushes for everything else
+                    self.logger.exception("Unexpected error in the polling loop - retrying in %i seconds" % kLoopErrorDelay)
+                    for deviceId in list(self.deviceList):
+                        if not self.pollScheduler.isScheduled(deviceId):
+                            self.pollScheduler.schedule(deviceId, kLoopErrorDelay)
+                    delay = kLoopErrorDelay
+                self.wakeup.wait(delay)
         except self.StopThread:
             self.logger.debug("Received StopThread - shutting down the dns browser")
             if self.bonjourBrowser:
                 self.bonjourBrowser.stopThread()
+            self.stopPushListener()
+            self.pollEngine.shutdown()
+            if self.asyncPoller:
+                self.asyncPoller.close()
+            with self.agentListLock:
+                if self.agentListPoller:
+                    self.agentListPoller.close()
+                    self.agentListPoller = None
+            self.prefetchExecutor.shutdown(wait=False, cancel_futures=True)
+            self.agentFetcher.close()
+            self.warmCache.save((device.id for device in indigo.devices.iter("self")), force=True)
+
+    ########################################
+    def runLoopOnce(self):
+        # One pass of the concurrent thread's loop. Returns how long to wait
+        # before the next one unless something wakes us sooner, None for as
+        # long as it takes.
+        self.applyNamePrefixes()
+        self.applyDiscoveryCommands()
+        nextPrefetchDelay = self.prefetchDiscoveredServers()
+        self.applyPushedDocuments()
+        # Newly started devices go first, most urgent first, then whatever is due
+        dueDeviceIds = self.takeWarmUpDevices()
+        dueDeviceIds.extend(deviceId for deviceId in self.pollScheduler.popDue() if deviceId not in dueDeviceIds)
+        if dueDeviceIds:
+            deferredDeviceIds = self.pollDevices(dueDeviceIds)
+            for deviceId in dueDeviceIds:
+                if deviceId in self.deviceList and deviceId in indigo.devices:
+                    if deviceId in deferredDeviceIds:
+                        self.pollScheduler.schedule(deviceId, kDeferredPollDelay)
+                    else:
+                        self.scheduleNextPoll(indigo.devices[deviceId])
+            self.clearRecoveredServers()
+            self.agentFetcher.sessionPool.evictIdle()
+            self.warmCache.save(device.id for device in indigo.devices.iter("self"))
+        # Sleep until the next device or prefetch is due, or until discovery,
+        # a push, a device start or a stop request wakes us
+        delays = [delay for delay in (self.pollScheduler.secondsUntilNextDue(), nextPrefetchDelay) if delay is not None]
+        return min(delays) if delays else None
+
+    ########################################
+    def stopConcurrentThread(self):
+        super(Plugin, self).stopConcurrentThread()
+        self.wakeup.set()
+
+    ########################################
+    def applyNamePrefixes(self):
+        namePrefixes = self.requestedNamePrefixes
+        if namePrefixes == self.bonjourNamePrefixes:
+            return
+        # Browse again so services that only match the new prefixes are found
+        self.bonjourNamePrefixes = namePrefixes
+        for instanceKey in [key for key in self.localWsServers if not key.startswith(namePrefixes)]:
+            self.prefetchDue.pop(self.localWsServers.pop(instanceKey), None)
+        self.bonjourBrowser.stopThread()
+        self.startBonjourBrowser()
+
+    ########################################
+    def applyDiscoveryCommands(self):
+        # Update our server list from what the Bonjour browser has found or lost
+        while not self.bonjourBrowserCommandQueue.empty():
+            command, name, host, port = self.bonjourBrowserCommandQueue.get()
+            self.logger.debug("command: %s" % ((command, name, host, port),))
+            # The browser only reports matching services, but commands queued
+            # before the name prefixes were changed may still be waiting
+            if not name.startswith(self.bonjourNamePrefixes):
+                continue
+            instanceKey = "%s@%s:%s" % (name, host, port)
+            if command == "add":
+                self.localWsServers[instanceKey] = "%s:%s" % (host, port)
+            else:
+                server = self.localWsServers.pop(instanceKey, None)
+                if server:
+                    self.prefetchDue.pop(server, None)
+            self.logger.debug("Server list: %s" % self.localWsServers)
+
+    ########################################
+    def prefetchDiscoveredServers(self):
+        # Read the agent list and properties of every server Bonjour has found
+        # into the dialog caches, and again each time the prefetch TTL runs out.
+        # Returns the seconds until the next prefetch is due, None if none is.
+        if not self.pluginPrefs.get("prefetchOnDiscovery", False):
+            return None
+        ttl = self.getIntProp(self.pluginPrefs, "prefetchTtl", kDefaultPrefetchTtl)
+        now = time.time()
+        nextDue = None
+        for server in set(self.localWsServers.values()):
+            if self.prefetchDue.get(server, 0) <= now:
+                self.prefetchDue[server] = now + ttl
+                self.prefetchExecutor.submit(self.prefetchServer, server, ttl)
+            if nextDue is None or self.prefetchDue[server] < nextDue:
+                nextDue = self.prefetchDue[server]
+        return None if nextDue is None else max(0, nextDue - now)
+
+    ########################################
+    def prefetchServer(self, server, ttl):
+        self.logger.debug("Prefetching agents from %s" % server)
+        try:
+            self.fetchAgentList(server, {}, ttl)
+        except Exception as exc:
+            self.logger.debug("Couldn't prefetch agents from %s: %s" % (server, exc))
+
+    ########################################
+    def takeWarmUpDevices(self):
+        # In priority order, skipping devices stopped since they were queued
+        deviceIds = []
+        while not self.warmUpQueue.empty():
+            priority, deviceId = self.warmUpQueue.get()
+            if deviceId in self.deviceList and deviceId not in deviceIds:
+                self.pollScheduler.unschedule(deviceId)
+                deviceIds.append(deviceId)
+        return deviceIds
+
+    ########################################
+    def startPushListener(self, prefs):
+        if not prefs.get("enablePushListener", False):
+            return
+        port = int(prefs.get("pushListenerPort", pushListener.kDefaultPushPort))
+        address = prefs.get("pushListenerAddress", "").strip() or pushListener.kDefaultPushAddress
+        secret = prefs.get("pushListenerSecret", "")
+        try:
+            self.pushListener = pushListener.PushListenerThread(port, self.pushQueue, address, secret)
+        except OSError as exc:
+            self.logger.error("Couldn't start the push listener on %s:%i: %s" % (address, port, exc))
+            return
+        if not secret and not ipaddress.ip_address(address).is_loopback:
+            self.logger.warning("The push listener accepts agent updates from the network without a shared secret")
+        self.pushListener.start()
+
+    ########################################
+    def stopPushListener(self):
+        if self.pushListener:
+            self.pushListener.stopThread()
+            self.pushListener = None
+
+    ########################################
+    def applyPushedDocuments(self):
+        # Route agent documents POSTed to the push listener into the normal state
+        # pipeline for every device on that agent. A pushed update also counts as
+        # that device's poll, so agents that push regularly are never polled.
+        while not self.pushQueue.empty():
+            target, host, document = self.pushQueue.get()
+            devices = []
+            for deviceId in list(self.deviceList):
+                if deviceId not in indigo.devices:
+                    continue
+                device = indigo.devices[deviceId]
+                if self.pushTargetMatches(device.pluginProps.get("wsAgent", ""), target, host):
+                    devices.append(device)
+            if not devices:
+                self.logger.debug("Pushed update for %s doesn't match any agent device" % target)
+                continue
+            servers = set(wsHttp.hostKeyForUrl(device.pluginProps["wsAgent"]) for device in devices)
+            if len(servers) > 1:
+                # Only the path was given and several servers have an agent there
+                self.logger.warning("Ignoring pushed update for %s: agents on %s all use that path - add a host or uri parameter to the push URL"
+                                    % (target, ", ".join(sorted(servers))))
+                continue
+            for device in devices:
+                self.deviceCounters[device.id]["pushes"] += 1
+                self.updateFromAgentDocument(device, document)
+                self.scheduleNextPoll(device)
+
+    ########################################
+    def pushTargetMatches(self, wsAgent, target, host):
+        # target is a full agent URI or just its path, host the optional
+        # host[:port] of the server the push came from
+        if target == wsAgent:
+            return True
+        agentParts = parse.urlsplit(wsAgent)
+        if not agentParts.hostname or target != agentParts.path:
+            return False
+        if not host:
+            return True
+        try:
+            return wsHttp.hostKeyForUrl("%s://%s" % (agentParts.scheme or "http", host)) == wsHttp.hostKeyForUrl(wsAgent)
+        except ValueError:
+            return False
+
+    ########################################
+    def getIntProp(self, props, key, default):
+        try:
+            return max(1, int(props.get(key, default)))
+        except:
+            return default
+
+    ########################################
+    def devicePollInterval(self, device):
+        interval = self.getIntProp(device.pluginProps, "pollInterval", kDefaultPollInterval)
+        if device.pluginProps.get("adaptivePolling", False):
+            interval = self.adaptiveIntervals.intervalFor(device.id, interval)
+        return interval
+
+    ########################################
+    def scheduleNextPoll(self, device):
+        interval = self.devicePollInterval(device)
+        self.pollScheduler.schedule(device.id, interval)
+        interval = int(round(interval))
+        if device.states.get("pollInterval", None) != interval:
+            device.updateStateOnServer("pollInterval", interval)
+
+    ########################################
+    def recordAgentActivity(self, device, changed):
+        props = device.pluginProps
+        if props.get("adaptivePolling", False):
+            interval = self.adaptiveIntervals.recordPoll(device.id, changed,
+                                                         self.getIntProp(props, "pollInterval", kDefaultPollInterval),
+                                                         self.getIntProp(props, "minPollInterval", kDefaultMinPollInterval),
+                                                         self.getIntProp(props, "maxPollInterval", kDefaultMaxPollInterval))
+            self.logger.threaddebug("Adaptive interval for \"%s\" is now %.1f seconds (changed: %s)" % (device.name, interval, changed))
+
+    ########################################
+    def pollDevices(self, deviceIds):
+        # Returns the devices that couldn't be polled within the cycle's time budget
+        startTime = time.time()
+        deadline = startTime + self.pollCycleBudget
+        backend = self.pluginPrefs.get("pollBackend", kPollBackendThreads)
+        if backend == kPollBackendSerial:
+            # The original one-device-at-a-time loop, kept for comparison
+            deferredDeviceIds = []
+            for deviceId in deviceIds:
+                if time.time() > deadline:
+                    deferredDeviceIds.append(deviceId)
+                elif deviceId in indigo.devices:
+                    self.deviceCounters[deviceId]["polls"] += 1
+                    self.update(indigo.devices[deviceId])
+        else:
+            deferredDeviceIds = self.pollDevicesConcurrently(deviceIds, self.pollerForBackend(backend), deadline)
+        for deviceId in deferredDeviceIds:
+            self.deviceCounters[deviceId]["deadlineMisses"] += 1
+        if deferredDeviceIds:
+            self.logger.debug("%i devices missed the poll cycle deadline and will be retried" % len(deferredDeviceIds))
+        self.logger.debug("Poll cycle for %i devices took %.3f seconds (%s)" % (len(deviceIds), time.time() - startTime, backend))
+        return deferredDeviceIds
+
+    ########################################
+    def pollerForBackend(self, backend):
+        if backend == kPollBackendAsyncio:
+            if not self.asyncPoller:
+                self.asyncPoller = asyncPoller.AsyncPoller(self.agentFetcher,
+                                                           self.pluginPrefs.get("maxConcurrentRequests", pollEngine.kMaxConcurrentRequests),
+                                                           self.pluginPrefs.get("maxRequestsPerServer", pollEngine.kMaxRequestsPerServer),
+                                                           shouldStop=lambda: self.stopThread)
+            return self.asyncPoller
+        return self.pollEngine
+
+    ########################################
+    def pollDevicesConcurrently(self, deviceIds, poller, deadline):
+        # Fetch every agent in parallel, then apply each result here on the
+        # concurrent thread as it comes back. Devices that share an agent URI
+        # share a single request and JSON decode.
+        subscribers = {}
+        for deviceId in deviceIds:
+            if deviceId in indigo.devices and indigo.devices[deviceId].deviceTypeId == "ws3station":
+                subscribers.setdefault(indigo.devices[deviceId].pluginProps["wsAgent"], []).append(deviceId)
+        jobs = [(url, url) for url in subscribers]
+        deferredDeviceIds = []
+        for url, document, exc in poller.fetchAll(jobs, deadline):
+            if isinstance(exc, wsHttp.DeadlineMissedError):
+                deferredDeviceIds.extend(subscribers[url])
+                continue
+            for deviceId in subscribers[url]:
+                # Refetch the device so we apply to its current props
+                if deviceId not in self.deviceList or deviceId not in indigo.devices:
+                    continue
+                device = indigo.devices[deviceId]
+                self.deviceCounters[deviceId]["polls"] += 1
+                if exc:
+                    self.setDeviceUnavailable(device, exc)
+                else:
+                    self.updateFromAgentDocument(device, document)
+        return deferredDeviceIds
 
     ########################################
     def getWs3SiteData(self, url):
-        reply = requests.get(url)
-        siteInformation = reply.json()
-        return siteInformation
+        # Callers asking for the same agent at the same time share one request
+        return self.agentFetcher.fetchDocument(url).data
 
     ########################################
     def update(self,device):
-        localPropsCopy = device.pluginProps
-        localPropsUpdated = False
         # self.logger.debug("Updating device: " + device.name)
+        if device.deviceTypeId == "ws3station":
+            try:
+                document = self.agentFetcher.fetchDocument(device.pluginProps["wsAgent"])
+            except Exception as exc:
+                self.setDeviceUnavailable(device, exc)
+                return
+            self.updateFromAgentDocument(device, document)
+
+    ########################################
+    def updateFromAgentDocument(self, device, document):
+        if self.appliedPayloads.get(device.id, None) == document.token:
+            # The agent sent exactly what we last pushed to this device (or a 304),
+            # so there's nothing to rebuild, diff or update.
+            self.recordAgentActivity(device, False)
+            return
+        if self.updateFromAgentData(device, document.data):
+            # While the deadband holds a reading back the same payload has to go
+            # through the pipeline again, or its max= staleness never releases it
+            if device.id in self.deadbandHeldBack:
+                self.appliedPayloads.pop(device.id, None)
+            else:
+                self.appliedPayloads[device.id] = document.token
+            self.warmCache.record(device.id, device.pluginProps["wsAgent"], document)
+
+    ########################################
+    def updateFromAgentData(self, device, agentInformation):
+        localPropsCopy = device.pluginProps
         if device.deviceTypeId == "ws3station":
             # update the fields
             try:
                 keyValueList = []
-                agentInformation = self.getWs3SiteData(localPropsCopy["wsAgent"])
                 if "dataVersion" in agentInformation:
                     siteInformation = agentInformation["agent"]["site"]
                     props = agentInformation["agent"]["properties"]
@@ -393,6 +863,10 @@ class Plugin(indigo.PluginBase):
                     props = siteInformation["properties"]
                     self.updateWs3KeyValueList(device, siteInformation, "agent", keyValueList=keyValueList)
                     self.updateWs3KeyValueList(device, siteInformation, "uri", keyValueList=keyValueList)
+                previousProps = self.lastAgentProperties.get(device.id, None)
+                self.lastAgentProperties[device.id] = props
+                if previousProps is not None:
+                    self.recordAgentActivity(device, props != previousProps)
                 # Get the fixed state values
                 self.updateWs3KeyValueList(device, agentInformation["software"], "version", keyValueList=keyValueList)
                 self.updateWs3KeyValueList(device, siteInformation, "name", keyValueList=keyValueList)
@@ -401,63 +875,115 @@ class Plugin(indigo.PluginBase):
                 self.updateWs3KeyValueList(device, siteInformation, "latitude", keyValueList=keyValueList)
                 self.updateWs3KeyValueList(device, siteInformation, "elevation", keyValueList=keyValueList)
 
-                newStateList = self.buildDynamicDeviceStates(props)
-                statesDiff = self.diffStatesList(localPropsCopy["dynamicStates"], newStateList)
-                if statesDiff:
-                    if len(keyValueList) > 0:	# Before we add new states better go ahead and push updates first.
-                        device.updateStatesOnServer(keyValueList)
-                        keyValueList = []
-                    self.logger.debug("  update added states:\n%s" % statesDiff["addedStates"])
-                    self.logger.debug("  update deleted states:\n%s" % statesDiff["deletedStates"])
-                    self.logger.debug("  update: updating props on the server")
-                    localPropsCopy["dynamicStates"] = newStateList
-                    device.replacePluginPropsOnServer(localPropsCopy)
-                    device.stateListOrDisplayStateIdChanged()
+                # The dynamic state list only needs rebuilding and diffing when the
+                # shape of the agent's properties has changed since we last checked
+                fingerprint = schemaFingerprint(props)
+                if self.schemaFingerprints.get(device.id, None) != fingerprint:
+                    newStateList = self.buildDynamicDeviceStates(props)
+                    # A device that started without a state list builds one here
+                    statesDiff = self.diffStatesList(localPropsCopy.get("dynamicStates", []), newStateList)
+                    if statesDiff:
+                        if len(keyValueList) > 0:	# Before we add new states better go ahead and push updates first.
+                            self.pushChangedStates(device, keyValueList)
+                            keyValueList = []
+                        self.logger.debug("  update added states:\n%s" % statesDiff["addedStates"])
+                        self.logger.debug("  update deleted states:\n%s" % statesDiff["deletedStates"])
+                        self.logger.debug("  update: updating props on the server")
+                        localPropsCopy["dynamicStates"] = newStateList
+                        device.replacePluginPropsOnServer(localPropsCopy)
+                        device.stateListOrDisplayStateIdChanged()
+                        self.deviceStateCache.pop(device.id, None)
+                    self.schemaFingerprints[device.id] = fingerprint
 
                 # Update the states with the new data
-                for stateIdBase, stateDict in props.items():
-                    uiVal = ""
-                    valuesList = stateDict["values"]
-                    for valueDict in valuesList:
-                        if len(valuesList) == 1:
-                            stateKey = stateIdBase
-                        else:
-                            stateKey = "%s_%s" % (stateIdBase, valueDict["unit"])
-
-                        # If there's a unit, let's pull it out and append it to the uiVal
-                        if "unit" in valueDict:
-                            unit = valueDict["unit"]
-                            if unit != "-":
-                                if unit == "F":
-                                    uiVal = " °F"
-                                elif unit == "C":
-                                    uiVal = " °C"
-                                elif unit == "pct":
-                                    uiVal = "%"
-                                elif unit == "deg":
-                                    if valueDict.get("type", "int") == "float":
-                                        uiVal = "° (%s)" % getWindDirectionCardinal(float(valueDict.get("value", 0.0)))[0]
-                                    else:
-                                        uiVal = "° (%s)" % getWindDirectionCardinal(int(valueDict.get("value", 0)))[0]
-                                else:
-                                    uiVal = " %s" % unit
-                        self.updateWs3KeyValueList(device, valueDict, "value", valueDict["type"], stateKey, uiVal, keyValueList=keyValueList)
-
-                if len(keyValueList) > 0:
-                    device.updateStatesOnServer(keyValueList)
+                plan = self.statePlanFor(fingerprint, props)
+                plan.apply(props, device.name, keyValueList)
+                self.pushChangedStates(device, keyValueList, plan.stateUnits)
+                return True
             except Exception as exc:
-                stack_trace = traceback.format_exc(10)
-                if device.errorState != kUnavailableString:
-                    self.logger.error("Couldn't get site information from WeatherSnoop for device \"%s\" - check to see if WeatherSnoop is running correctly." % device.name)
-                    device.setErrorStateOnServer(kUnavailableString)
-                    self.logger.debug("Error specifics:\n%s" % traceback.format_exc(10))
+                self.setDeviceUnavailable(device, exc)
+        return False
+
+    ########################################
+    def statePlanFor(self, fingerprint, properties):
+        # Devices on agents with the same schema share one plan
+        plan = self.statePlans.get(fingerprint, None)
+        if plan is None:
+            # Drop plans no device is using any more before adding this one
+            for staleFingerprint in set(self.statePlans) - set(self.schemaFingerprints.values()):
+                del self.statePlans[staleFingerprint]
+            plan = statePlan.StatePlan(properties, statePlan.getWindDirectionCardinal)
+            self.statePlans[fingerprint] = plan
+        return plan
+
+    ########################################
+    def pushChangedStates(self, device, keyValueList, stateUnits=None):
+        # Only send the states whose value or displayed value differs from what we
+        # last pushed - most readings don't change from one poll to the next. Float
+        # readings with units (stateUnits maps state key to unit) also have to get
+        # past the configured deadband.
+        stateCache = self.deviceStateCache.setdefault(device.id, {})
+        now = time.time()
+        changedList = []
+        self.deadbandHeldBack.discard(device.id)
+        for stateUpdate in keyValueList:
+            pushedValue = (stateUpdate["value"], stateUpdate.get("uiValue", None), stateUpdate.get("decimalPlaces", None))
+            lastPushed = stateCache.get(stateUpdate["key"], None)
+            if lastPushed == pushedValue:
+                continue
+            if stateUnits is not None and lastPushed is not None and type(pushedValue[0]) is float and type(lastPushed[0]) is float:
+                if not self.deadbandFilter.allows(device.id, stateUpdate["key"], stateUnits.get(stateUpdate["key"], None), lastPushed[0], pushedValue[0], now):
+                    self.deadbandHeldBack.add(device.id)
+                    continue
+            changedList.append(stateUpdate)
+        if changedList:
+            device.updateStatesOnServer(changedList)
+            for stateUpdate in changedList:
+                stateCache[stateUpdate["key"]] = (stateUpdate["value"], stateUpdate.get("uiValue", None), stateUpdate.get("decimalPlaces", None))
+                self.deadbandFilter.recordPush(device.id, stateUpdate["key"], now)
+
+    ########################################
+    def setDeviceUnavailable(self, device, exc):
+        self.appliedPayloads.pop(device.id, None)
+        # Push everything again once the device recovers, which also clears the error
+        self.deviceStateCache.pop(device.id, None)
+        if wsHttp.isTimeout(exc):
+            self.deviceCounters[device.id]["timeouts"] += 1
+        if device.errorState != kUnavailableString:
+            self.logger.error("Couldn't get site information from WeatherSnoop for device \"%s\" - check to see if WeatherSnoop is running correctly." % device.name)
+            device.setErrorStateOnServer(kUnavailableString)
+            # Only pay for formatting the traceback when someone will see it
+            if self.debug and not isinstance(exc, wsHttp.ServerUnavailableError):
+                stack_trace = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__, limit=10))
+                self.logger.debug("Error specifics:\n%s" % stack_trace)
+
+    ########################################
+    def clearRecoveredServers(self):
+        # When a server that was down answers again, clear the error on every
+        # device it hosts at once and poll them all straight away rather than
+        # waiting for each one's next turn.
+        recoveredServers = self.agentFetcher.circuitBreakers.popRecovered()
+        if not recoveredServers:
+            return
+        for deviceId in list(self.deviceList):
+            if deviceId not in indigo.devices:
+                continue
+            device = indigo.devices[deviceId]
+            try:
+                hostKey = wsHttp.hostKeyForUrl(device.pluginProps.get("wsAgent", ""))
+            except ValueError:
+                continue
+            if hostKey in recoveredServers:
+                if device.errorState == kUnavailableString:
+                    device.setErrorStateOnServer(None)
+                self.pollScheduler.schedule(deviceId, 0)
 
     ########################################
     def diffStatesList(self, oldStates, newStates):
-        oldStatesList = map(lambda state: state["Key"], oldStates)
-        newStatesList = map(lambda state: state["Key"], newStates)
-        oldStatesLost = list(set(oldStatesList) - set(newStatesList))
-        newStatesLost = list(set(newStatesList) - set(oldStatesList))
+        oldStatesList = set(state["Key"] for state in oldStates)
+        newStatesList = set(state["Key"] for state in newStates)
+        oldStatesLost = list(oldStatesList - newStatesList)
+        newStatesLost = list(newStatesList - oldStatesList)
         if oldStatesLost or newStatesLost:
             return {"deletedStates": oldStatesLost, "addedStates": newStatesLost}
         return None
@@ -480,8 +1006,7 @@ class Plugin(indigo.PluginBase):
             except:
                 self.logger.debug("WeatherSnoop device \"%s\" reports an incorrect value type for state \"%s\" (can't be converted from string to %s)." % (device.name, propKey, type))
                 newValue = dictionary[property]
-            valueString = newValue
-            uiValueString = "".format(valueString, uiVal)
+            uiValueString = statePlan.formatUiValue(newValue, places, uiVal)
             keyValueList.append({'key':propKey, 'value':newValue, 'uiValue':uiValueString, 'decimalPlaces':places})
         else:
             self.logger.error("WeatherSnoop device \"%s\" no longer contains data for state %s." % (device.name, propKey))
@@ -494,6 +1019,29 @@ class Plugin(indigo.PluginBase):
 
     ########################################
     # UI Validate, Close, and Actions defined in Actions.xml:
+    ########################################
+    def pinAgentProperties(self, wsAgent):
+        # deviceStartComm builds a new device's state list from siteFieldCache,
+        # so make sure the chosen agent's properties are there, freshly timed
+        # and most recently used, when the dialog closes
+        props = self.siteFieldCache.get(wsAgent, None)
+        if props is None:
+            try:
+                agentInformation = self.agentFetcher.fetchDocument(wsAgent).data
+                if "dataVersion" in agentInformation:
+                    props = agentInformation["agent"]["properties"]
+                else:
+                    props = agentInformation["site"]["properties"]
+            except Exception as exc:
+                self.logger.debug("Couldn't read the properties of %s: %s" % (wsAgent, exc))
+                return False
+        self.siteFieldCache.put(wsAgent, props)
+        return True
+
+    ########################################
+    def deviceHasStateList(self, devId):
+        return bool(devId) and devId in indigo.devices and "dynamicStates" in indigo.devices[devId].pluginProps
+
     ########################################
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
         self.logger.debug("validateDeviceConfigUi devId: %s" % str(devId))
@@ -524,15 +1072,24 @@ class Plugin(indigo.PluginBase):
             m = p.match(valuesDict["wsAgent"])
             if m:
                 valuesDict["address"] = m.group(1)
+                if not self.pinAgentProperties(valuesDict["wsAgent"]) and not self.deviceHasStateList(devId):
+                    errorsDict["wsAgent"] = "Couldn't read this agent's states from WeatherSnoop. Make sure WeatherSnoop is running and try again."
             else:
                 errorsDict["wsAgent"] = "You must select an agent. If you manually selected an agent you can scan for agents by pressing the 'Scan for Agents' button above."
             if "displayState" not in valuesDict or valuesDict["displayState"] == "":
                 errorsDict["displayState"] = "You must select a state to display in the state column."
+            for key in ("pollInterval", "minPollInterval", "maxPollInterval"):
+                try:
+                    if int(valuesDict.get(key, kDefaultPollInterval)) < 1:
+                        errorsDict[key] = "Polling intervals must be at least 1 second."
+                except:
+                    errorsDict[key] = "Polling intervals must be a whole number of seconds."
+            if valuesDict.get("adaptivePolling", False) and "minPollInterval" not in errorsDict and "maxPollInterval" not in errorsDict:
+                if int(valuesDict.get("minPollInterval", kDefaultMinPollInterval)) > int(valuesDict.get("maxPollInterval", kDefaultMaxPollInterval)):
+                    errorsDict["maxPollInterval"] = "The longest interval can't be shorter than the shortest one."
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         else:
-            if typeId == "ws3station":
-                self.siteFieldCache = {valuesDict["wsAgent"]: self.siteFieldCache[valuesDict["wsAgent"]]}
             return (True, valuesDict)
 
     ########################################
@@ -596,6 +1153,20 @@ class Plugin(indigo.PluginBase):
 
     ########################################
     # Menu Methods
+    ########################################
+    def logPollStatistics(self):
+        indigo.server.log("Polling statistics (polls / pushes / timeouts / missed cycle deadlines / current interval):")
+        for deviceId in list(self.deviceList):
+            if deviceId not in indigo.devices:
+                continue
+            device = indigo.devices[deviceId]
+            counters = self.deviceCounters[deviceId]
+            indigo.server.log("  %s: %i / %i / %i / %i / %i seconds" % (device.name, counters["polls"], counters["pushes"], counters["timeouts"],
+                                                                         counters["deadlineMisses"], self.devicePollInterval(device)))
+        cacheStats = self.siteFieldCache.stats()
+        indigo.server.log("Site cache: %i entries, %i hits, %i misses, %i evictions" % (cacheStats["entries"], cacheStats["hits"],
+                                                                                      cacheStats["misses"], cacheStats["evictions"]))
+
     ########################################
     def toggleDebugging(self):
         if self.debug:
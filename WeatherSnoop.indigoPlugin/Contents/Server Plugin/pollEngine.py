@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Polling machinery for the concurrent thread: a scheduler that tracks when each
+# device is next due, and a bounded worker pool that fetches agent data for all
+# due devices in parallel so one slow or dead agent doesn't hold up the rest.
+
+import collections
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent import futures
+
+import wsHttp
+
+################################################################################
+# Globals
+################################################################################
+kMaxConcurrentRequests = 8  # requests in flight across all servers
+kMaxRequestsPerServer = 4   # requests in flight to any single server
+kPollJitter = 0.1           # +/- fraction of the interval added to each next due time
+kAdaptiveGrowFactor = 1.5   # stretch the interval after a poll where nothing changed
+kAdaptiveShrinkFactor = 0.5 # tighten it after a poll where the readings moved
+
+################################################################################
+class PollEngine(object):
+    def __init__(self, fetchMethod, maxConcurrent=kMaxConcurrentRequests, maxPerServer=kMaxRequestsPerServer):
+        self.logger = logging.getLogger("Plugin.pollEngine")
+        self.fetchMethod = fetchMethod
+        self.executor = None
+        self.maxConcurrent = 0
+        self.maxPerServer = 0
+        self.configure(maxConcurrent, maxPerServer)
+
+    ########################################
+    def configure(self, maxConcurrent, maxPerServer):
+        maxConcurrent = max(1, int(maxConcurrent))
+        self.maxPerServer = max(1, int(maxPerServer))
+        if maxConcurrent != self.maxConcurrent:
+            # Swap the new pool in before shutting the old one down, and let any
+            # requests still running on the old pool finish on their own
+            oldExecutor = self.executor
+            self.executor = futures.ThreadPoolExecutor(max_workers=maxConcurrent, thread_name_prefix="wsPoll")
+            self.maxConcurrent = maxConcurrent
+            if oldExecutor:
+                oldExecutor.shutdown(wait=False)
+        self.logger.debug("Poll engine: %i requests in flight, %i per server" % (self.maxConcurrent, self.maxPerServer))
+
+    ########################################
+    def serverForUrl(self, url):
+        try:
+            return wsHttp.hostKeyForUrl(url)
+        except ValueError:
+            # Let the fetch itself report the bad URL
+            return ""
+
+    ########################################
+    def submit(self, url):
+        while True:
+            executor = self.executor
+            try:
+                return executor.submit(self.fetchMethod, url)
+            except RuntimeError:
+                # configure() retired this pool since we picked it up - use the
+                # new one, but give up once the engine itself is shut down
+                if executor is self.executor:
+                    raise
+
+    ########################################
+    def fetchAll(self, jobs, deadline=None):
+        # jobs is a list of (key, url) pairs. Yields (key, result, exception) for
+        # each job as soon as it finishes so the caller can apply results while
+        # the remaining fetches are still running. Jobs not finished by the
+        # deadline are yielded with DeadlineMissedError; ones already running
+        # carry on in the background and later callers of the same URL pick
+        # up their result through the fetch coalescer.
+        waiting = collections.OrderedDict()
+        for key, url in jobs:
+            waiting.setdefault(self.serverForUrl(url), collections.deque()).append((key, url))
+        inFlight = {}
+        perServer = collections.Counter()
+        while waiting or inFlight:
+            for server in list(waiting.keys()):
+                serverJobs = waiting[server]
+                while serverJobs and perServer[server] < self.maxPerServer and len(inFlight) < self.maxConcurrent:
+                    key, url = serverJobs.popleft()
+                    inFlight[self.submit(url)] = (key, server)
+                    perServer[server] += 1
+                if not serverJobs:
+                    del waiting[server]
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            done, notDone = futures.wait(list(inFlight.keys()), timeout=timeout, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                key, server = inFlight.pop(future)
+                perServer[server] -= 1
+                exc = future.exception()
+                if exc:
+                    yield key, None, exc
+                else:
+                    yield key, future.result(), None
+        for key, server in inFlight.values():
+            yield key, None, wsHttp.DeadlineMissedError("Poll cycle time budget ran out")
+        for serverJobs in waiting.values():
+            for key, url in serverJobs:
+                yield key, None, wsHttp.DeadlineMissedError("Poll cycle time budget ran out")
+
+    ########################################
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+################################################################################
+class PollScheduler(object):
+    # Keeps the next due time for every device in a heap so the concurrent
+    # thread can sleep until exactly the next device needs polling. Entries
+    # are invalidated lazily: rescheduling or removing a device just updates
+    # dueTimes, and stale heap entries are dropped when they reach the top.
+    def __init__(self, jitter=kPollJitter):
+        self.jitter = jitter
+        self.heap = []      # (dueTime, sequence, deviceId)
+        self.dueTimes = {}  # deviceId -> current dueTime
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    ########################################
+    def schedule(self, deviceId, delay):
+        # Spread devices with the same interval so they don't all fire together
+        if delay > 0 and self.jitter:
+            delay += delay * random.uniform(-self.jitter, self.jitter)
+        dueTime = time.time() + max(0, delay)
+        with self.lock:
+            self.dueTimes[deviceId] = dueTime
+            heapq.heappush(self.heap, (dueTime, next(self.sequence), deviceId))
+
+    ########################################
+    def unschedule(self, deviceId):
+        with self.lock:
+            self.dueTimes.pop(deviceId, None)
+
+    ########################################
+    def isScheduled(self, deviceId):
+        with self.lock:
+            return deviceId in self.dueTimes
+
+    ########################################
+    def popDue(self):
+        now = time.time()
+        dueIds = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                dueTime, sequence, deviceId = heapq.heappop(self.heap)
+                if self.dueTimes.get(deviceId, None) == dueTime:
+                    del self.dueTimes[deviceId]
+                    dueIds.append(deviceId)
+        return dueIds
+
+    ########################################
+    def secondsUntilNextDue(self):
+        # None when nothing is scheduled
+        with self.lock:
+            while self.heap and self.dueTimes.get(self.heap[0][2], None) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.time())
+
+################################################################################
+class AdaptiveIntervals(object):
+    # Per-device poll interval that follows how often the agent's readings
+    # actually change: every unchanged poll stretches it and every change pulls
+    # it back in, so it settles where changes show up on a steady share of polls.
+    # Tightening is faster than backing off so a device catches up quickly once
+    # its values start moving again.
+    def __init__(self, growFactor=kAdaptiveGrowFactor, shrinkFactor=kAdaptiveShrinkFactor):
+        self.growFactor = growFactor
+        self.shrinkFactor = shrinkFactor
+        self.intervals = {}  # deviceId -> current interval in seconds
+        self.lock = threading.Lock()
+
+    ########################################
+    def recordPoll(self, deviceId, changed, startInterval, minInterval, maxInterval):
+        with self.lock:
+            interval = self.intervals.get(deviceId, startInterval)
+            interval *= self.shrinkFactor if changed else self.growFactor
+            interval = min(max(interval, minInterval), maxInterval)
+            self.intervals[deviceId] = interval
+        return interval
+
+    ########################################
+    def intervalFor(self, deviceId, default):
+        with self.lock:
+            return self.intervals.get(deviceId, default)
+
+    ########################################
+    def forget(self, deviceId):
+        with self.lock:
+            self.intervals.pop(deviceId, None)
+
+################################################################################
+class Wakeup(object):
+    # What the concurrent thread waits on between poll cycles: it sleeps until
+    # the next poll is due unless something is handed to it first through a
+    # WakeupQueue (discovery commands, pushed documents, devices to warm up)
+    # or set() is called directly. Clear before draining the queues so an
+    # item that arrives while they're being drained still cuts the wait short.
+    def __init__(self):
+        self.event = threading.Event()
+
+    ########################################
+    def set(self):
+        self.event.set()
+
+    ########################################
+    def clear(self):
+        self.event.clear()
+
+    ########################################
+    def wait(self, timeout=None):
+        # timeout None waits until woken
+        return self.event.wait(timeout)
+
+################################################################################
+class WakeupQueue(queue.Queue):
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    ########################################
+    def _put(self, item):
+        queue.Queue._put(self, item)
+        self.wakeup.set()
+
+################################################################################
+class WakeupPriorityQueue(queue.PriorityQueue):
+    def __init__(self, wakeup):
+        queue.PriorityQueue.__init__(self)
+        self.wakeup = wakeup
+
+    ########################################
+    def _put(self, item):
+        queue.PriorityQueue._put(self, item)
+        self.wakeup.set()
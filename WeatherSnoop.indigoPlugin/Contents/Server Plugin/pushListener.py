@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Optional HTTP listener that accepts agent documents POSTed by a relay script
+# (or anything else that knows when an agent changes) so those devices don't
+# have to wait for their next poll. A document must have the same shape as an
+# agent reply from WeatherSnoop, and is routed by the agent URI it's posted to:
+#
+#   POST http://<indigo server>:<port>/api/v1/sites/<site>/agents/<agent>.json
+#
+# with the WeatherSnoop server it came from in a "host" query parameter
+# (host[:port] as in the device's agent URL), or, for relays that can't choose
+# the path, POST to any path with the full agent URI in a "uri" query
+# parameter. A path without a host is only accepted while no other WeatherSnoop
+# server has an agent device at the same path.
+#
+# The listener only binds to the loopback address unless told otherwise, and
+# when a shared secret is configured every POST has to carry it in an
+# X-Push-Secret header.
+
+import hashlib
+import hmac
+import http.server
+import logging
+import threading
+from urllib import parse
+
+try:
+    import json
+except:
+    import simplejson as json
+
+import wsHttp
+
+################################################################################
+# Globals
+################################################################################
+kDefaultPushPort = 9176
+kDefaultPushAddress = "127.0.0.1"
+kSecretHeader = "X-Push-Secret"
+kMaxPushBodySize = 1024 * 1024
+
+########################################
+def agentDocumentProblem(data):
+    # What's missing for the plugin to build states from this document (the
+    # parts updateFromAgentData and buildDynamicDeviceStates rely on), or None
+    if not isinstance(data, dict):
+        return "The body isn't a JSON object"
+    if not isinstance(data.get("software", None), dict):
+        return "The document has no software section"
+    if "dataVersion" in data:
+        agent = data.get("agent", None)
+        if not isinstance(agent, dict) or not isinstance(agent.get("site", None), dict):
+            return "The document has no agent or site section"
+        properties = agent.get("properties", None)
+    else:
+        site = data.get("site", None)
+        if not isinstance(site, dict):
+            return "The document has no site section"
+        properties = site.get("properties", None)
+    if not isinstance(properties, dict):
+        return "The document has no properties"
+    for propertyId, propertyDict in properties.items():
+        if not isinstance(propertyDict, dict) or "name" not in propertyDict:
+            return "Property %s has no name" % propertyId
+        values = propertyDict.get("values", None)
+        if not isinstance(values, list) or not values:
+            return "Property %s has no values" % propertyId
+        for valueDict in values:
+            if not isinstance(valueDict, dict) or "type" not in valueDict:
+                return "A value of property %s has no type" % propertyId
+            if len(values) > 1 and not ("unit" in valueDict and "label" in valueDict):
+                return "A value of property %s has no unit or label" % propertyId
+    return None
+
+################################################################################
+class PushRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ########################################
+    def do_POST(self):
+        if self.server.secret and not hmac.compare_digest(self.headers.get(kSecretHeader, "").encode("utf-8"), self.server.secret.encode("utf-8")):
+            # The body is left unread, so this connection can't be reused
+            self.close_connection = True
+            self.sendReply(403, "A valid %s header is required" % kSecretHeader)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > kMaxPushBodySize:
+            self.sendReply(400, "A JSON body with a Content-Length of up to %i bytes is required" % kMaxPushBodySize)
+            return
+        body = self.rfile.read(length)
+        try:
+            data = json.loads(body.decode("utf-8"))
+        except ValueError:
+            self.sendReply(400, "The body isn't valid JSON")
+            return
+        problem = agentDocumentProblem(data)
+        if problem:
+            self.sendReply(400, "The body isn't a WeatherSnoop agent document: %s" % problem)
+            return
+        parts = parse.urlsplit(self.path)
+        query = parse.parse_qs(parts.query)
+        target = query.get("uri", [parse.unquote(parts.path)])[0]
+        host = query.get("host", [None])[0]
+        # Same token scheme as PayloadTracker, so a poll that returns these exact
+        # bytes afterwards is recognised as unchanged
+        token = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.server.pushQueue.put((target, host, wsHttp.AgentDocument(data, token)))
+        self.sendReply(202, "Accepted")
+
+    ########################################
+    def sendReply(self, status, message):
+        body = message.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ########################################
+    def log_message(self, format, *args):
+        self.server.logger.threaddebug("push listener: %s - %s" % (self.address_string(), format % args))
+
+################################################################################
+class PushListenerThread(threading.Thread):
+    def __init__(self, port, pushQueue, address=kDefaultPushAddress, secret=""):
+        # address "0.0.0.0" listens on every interface
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger("Plugin.pushListener")
+        self.server = http.server.ThreadingHTTPServer((address, port), PushRequestHandler)
+        self.server.daemon_threads = True
+        self.server.pushQueue = pushQueue
+        self.server.secret = secret
+        self.server.logger = self.logger
+
+    ########################################
+    def run(self):
+        self.logger.debug("Push listener accepting agent updates on %s:%i" % self.server.server_address[:2])
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    ########################################
+    def stopThread(self):
+        self.server.shutdown()
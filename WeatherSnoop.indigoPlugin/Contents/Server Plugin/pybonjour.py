@@ -135,6 +135,7 @@ kDNSServiceFlagsLongLivedQuery      = 0x100
 kDNSServiceFlagsAllowRemoteQuery    = 0x200
 kDNSServiceFlagsForceMulticast      = 0x400
 kDNSServiceFlagsReturnCNAME         = 0x800
+kDNSServiceFlagsShareConnection     = 0x4000
 
 
 #
@@ -306,11 +307,10 @@ class _utf8_char_p(ctypes.c_char_p):
     @classmethod
     def from_param(cls, obj):
         if (obj is not None) and (not isinstance(obj, cls)):
-            if not isinstance(obj, basestring):
+            if not isinstance(obj, (str, bytes)):
                 raise TypeError('parameter must be a string type instance')
-            if not isinstance(obj, unicode):
-                obj = unicode(obj)
-            obj = obj.encode('utf-8')
+            if isinstance(obj, str):
+                obj = obj.encode('utf-8')
         return ctypes.c_char_p.from_param(obj)
 
     def decode(self):
@@ -819,6 +819,16 @@ def _create_function_bindings():
 
         globals()['_' + name] = func
 
+    # Variants that start an operation on a shared connection: sdRef is
+    # passed in holding the connection's ref (with the ShareConnection
+    # flag) and the library replaces it with the new operation's ref
+    for name in ('DNSServiceBrowse', 'DNSServiceResolve', 'DNSServiceQueryRecord'):
+        restype, errcheck, outparam, argtypes = specs[name]
+        prototype = _CFunc(restype, *argtypes)
+        func = prototype((name, _libdnssd), tuple((1,) for argtype in argtypes))
+        func.errcheck = BonjourError._errcheck
+        globals()['_' + name + 'Shared'] = func
+
 
 # Only need to do this once
 _create_function_bindings()
@@ -854,8 +864,7 @@ def _string_to_length_and_void_p(string):
 
 
 def _length_and_void_p_to_string(length, void_p):
-    char_p = ctypes.cast(void_p, ctypes.POINTER(ctypes.c_char))
-    return ''.join(char_p[i] for i in xrange(length))
+    return ctypes.string_at(void_p, length)
 
 
 
@@ -1305,6 +1314,7 @@ def DNSServiceBrowse(
     regtype = _NO_DEFAULT,
     domain = None,
     callBack = None,
+    connection = None,
     ):
 
     """
@@ -1337,6 +1347,14 @@ def DNSServiceBrowse(
         callBack(sdRef, flags, interfaceIndex, errorCode,
                  serviceName, regtype, replyDomain).
 
+      connection:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection() to run the operation on.  Replies
+        then arrive on that connection (pass it, not the returned
+        DNSServiceRef, to select() and DNSServiceProcessResult()), and
+        closing the returned DNSServiceRef ends only this operation.
+        It must be closed before the connection is.
+
       return value:
         A DNSServiceRef instance.  The browse operation will run
         indefinitely until the client terminates it by closing the
@@ -1401,12 +1419,22 @@ def DNSServiceBrowse(
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceBrowse(flags,
-                                  interfaceIndex,
-                                  regtype,
-                                  domain,
-                                  _callback,
-                                  None)
+        if connection is not None:
+            sdRef = DNSServiceRef(connection.value)
+            _DNSServiceBrowseShared(ctypes.byref(sdRef),
+                                    flags | kDNSServiceFlagsShareConnection,
+                                    interfaceIndex,
+                                    regtype,
+                                    domain,
+                                    _callback,
+                                    None)
+        else:
+            sdRef = _DNSServiceBrowse(flags,
+                                      interfaceIndex,
+                                      regtype,
+                                      domain,
+                                      _callback,
+                                      None)
     finally:
         _global_lock.release()
 
@@ -1422,6 +1450,7 @@ def DNSServiceResolve(
     regtype = _NO_DEFAULT,
     domain = _NO_DEFAULT,
     callBack = None,
+    connection = None,
     ):
 
     """
@@ -1472,6 +1501,14 @@ def DNSServiceResolve(
         callBack(sdRef, flags, interfaceIndex, errorCode, fullname,
                  hosttarget, port, txtRecord).
 
+      connection:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection() to run the operation on.  Replies
+        then arrive on that connection (pass it, not the returned
+        DNSServiceRef, to select() and DNSServiceProcessResult()), and
+        closing the returned DNSServiceRef ends only this operation.
+        It must be closed before the connection is.
+
       return value:
         A DNSServiceRef instance.  The resolve operation will run
         indefinitely until the client terminates it by closing the
@@ -1526,13 +1563,24 @@ def DNSServiceResolve(
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceResolve(flags,
-                                   interfaceIndex,
-                                   name,
-                                   regtype,
-                                   domain,
-                                   _callback,
-                                   None)
+        if connection is not None:
+            sdRef = DNSServiceRef(connection.value)
+            _DNSServiceResolveShared(ctypes.byref(sdRef),
+                                     flags | kDNSServiceFlagsShareConnection,
+                                     interfaceIndex,
+                                     name,
+                                     regtype,
+                                     domain,
+                                     _callback,
+                                     None)
+        else:
+            sdRef = _DNSServiceResolve(flags,
+                                       interfaceIndex,
+                                       name,
+                                       regtype,
+                                       domain,
+                                       _callback,
+                                       None)
     finally:
         _global_lock.release()
 
@@ -1686,6 +1734,7 @@ def DNSServiceQueryRecord(
     rrtype = _NO_DEFAULT,
     rrclass = kDNSServiceClass_IN,
     callBack = None,
+    connection = None,
     ):
 
     """
@@ -1724,6 +1773,14 @@ def DNSServiceQueryRecord(
         callBack(sdRef, flags, interfaceIndex, errorCode, fullname,
                  rrtype, rrclass, rdata, ttl).
 
+      connection:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection() to run the operation on.  Replies
+        then arrive on that connection (pass it, not the returned
+        DNSServiceRef, to select() and DNSServiceProcessResult()), and
+        closing the returned DNSServiceRef ends only this operation.
+        It must be closed before the connection is.
+
       return value:
         A DNSServiceRef instance.  The query operation will run
         indefinitely until the client terminates it by closing the
@@ -1779,13 +1836,24 @@ def DNSServiceQueryRecord(
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceQueryRecord(flags,
-                                       interfaceIndex,
-                                       fullname,
-                                       rrtype,
-                                       rrclass,
-                                       _callback,
-                                       None)
+        if connection is not None:
+            sdRef = DNSServiceRef(connection.value)
+            _DNSServiceQueryRecordShared(ctypes.byref(sdRef),
+                                         flags | kDNSServiceFlagsShareConnection,
+                                         interfaceIndex,
+                                         fullname,
+                                         rrtype,
+                                         rrclass,
+                                         _callback,
+                                         None)
+        else:
+            sdRef = _DNSServiceQueryRecord(flags,
+                                           interfaceIndex,
+                                           fullname,
+                                           rrtype,
+                                           rrclass,
+                                           _callback,
+                                           None)
     finally:
         _global_lock.release()
 
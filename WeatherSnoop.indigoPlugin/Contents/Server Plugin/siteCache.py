@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Bounded cache for agent data the config dialog collects while the user is
+# choosing a site (see siteFieldCache in plugin.py). Entries expire after a
+# fixed time and the least recently used ones are dropped once the cache is
+# full, so servers with dozens of sites don't grow it across dialog sessions.
+# The dialog callbacks and the concurrent thread both use it, so every access
+# takes the lock.
+
+import collections
+import threading
+import time
+
+################################################################################
+# Globals
+################################################################################
+kSiteCacheMaxEntries = 64
+kSiteCacheTtl = 600     # seconds
+
+################################################################################
+class SiteCache(object):
+    def __init__(self, maxEntries=kSiteCacheMaxEntries, ttl=kSiteCacheTtl):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()    # key -> (expiresAt, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    ########################################
+    def lookup(self, key, remove):
+        # Must be called with the lock held
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[0] <= time.time():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if remove:
+            del self.entries[key]
+        else:
+            self.entries.move_to_end(key)
+        return entry
+
+    ########################################
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.lookup(key, False)
+        return default if entry is None else entry[1]
+
+    ########################################
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.lookup(key, True)
+        return default if entry is None else entry[1]
+
+    ########################################
+    def put(self, key, value, ttl=None):
+        # ttl overrides the cache's default lifetime for this entry
+        with self.lock:
+            self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            self.trim()
+
+    ########################################
+    def trim(self):
+        # Must be called with the lock held
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    ########################################
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    ########################################
+    def keys(self):
+        now = time.time()
+        with self.lock:
+            return [key for key, entry in self.entries.items() if entry[0] > now]
+
+    ########################################
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
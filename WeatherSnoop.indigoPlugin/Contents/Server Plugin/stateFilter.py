@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Deadband filtering for float states so sensor noise (wind speed, solar
+# radiation, ...) doesn't fire triggers on every poll. Rules come from the
+# plugin prefs as text, one rule per line or separated by semicolons:
+#
+#   <selector> abs=<amount> rel=<percent> min=<seconds> max=<seconds>
+#
+# where the selector is a state id (windSpeed_mph), a unit class in brackets
+# ([mph]) or * for every float state. The most specific rule wins. A value is
+# pushed when it has moved more than abs, or more than rel percent, from the
+# last value pushed, or when max seconds have passed since that push - but never
+# sooner than min seconds after it. All options are optional.
+
+import re
+import threading
+
+################################################################################
+# Globals
+################################################################################
+kRuleOptions = {"abs": "absolute", "rel": "relative", "min": "minInterval", "max": "maxStaleness"}
+
+################################################################################
+class DeadbandRule(object):
+    __slots__ = ("absolute", "relative", "minInterval", "maxStaleness")
+
+    def __init__(self):
+        self.absolute = 0.0
+        self.relative = 0.0     # fraction, not percent
+        self.minInterval = 0.0
+        self.maxStaleness = 0.0
+
+########################################
+def parseDeadbandRules(text):
+    # Raises ValueError describing the first bad entry
+    rules = {}
+    for entry in re.split(r"[;\n]", text or ""):
+        fields = entry.split()
+        if not fields:
+            continue
+        rule = DeadbandRule()
+        for option in fields[1:]:
+            name, separator, value = option.partition("=")
+            if not separator or name not in kRuleOptions:
+                raise ValueError("Unknown option \"%s\" in deadband rule \"%s\"" % (option, entry.strip()))
+            try:
+                number = float(value.rstrip("%"))
+            except ValueError:
+                raise ValueError("\"%s\" isn't a number in deadband rule \"%s\"" % (value, entry.strip()))
+            if number < 0:
+                raise ValueError("\"%s\" can't be negative in deadband rule \"%s\"" % (option, entry.strip()))
+            if name == "rel":
+                number /= 100.0
+            setattr(rule, kRuleOptions[name], number)
+        rules[fields[0]] = rule
+    return rules
+
+################################################################################
+class DeadbandFilter(object):
+    def __init__(self, rules=None):
+        self.rules = rules or {}
+        self.pushTimes = {}     # deviceId -> {stateKey: time last pushed}
+        self.lock = threading.Lock()
+
+    ########################################
+    def configure(self, rules):
+        self.rules = rules
+
+    ########################################
+    def ruleFor(self, stateKey, unit):
+        rule = self.rules.get(stateKey, None)
+        if rule is None and unit:
+            rule = self.rules.get("[%s]" % unit, None)
+        if rule is None:
+            rule = self.rules.get("*", None)
+        return rule
+
+    ########################################
+    def allows(self, deviceId, stateKey, unit, lastValue, newValue, now):
+        # lastValue is the value last pushed to the server for this state
+        rule = self.ruleFor(stateKey, unit)
+        if rule is None:
+            return True
+        with self.lock:
+            lastPushTime = self.pushTimes.get(deviceId, {}).get(stateKey, None)
+        if lastPushTime is None:
+            return True
+        elapsed = now - lastPushTime
+        if elapsed < rule.minInterval:
+            return False
+        if rule.maxStaleness and elapsed >= rule.maxStaleness:
+            return True
+        return abs(newValue - lastValue) > max(rule.absolute, rule.relative * abs(lastValue))
+
+    ########################################
+    def recordPush(self, deviceId, stateKey, now):
+        with self.lock:
+            self.pushTimes.setdefault(deviceId, {})[stateKey] = now
+
+    ########################################
+    def forget(self, deviceId):
+        with self.lock:
+            self.pushTimes.pop(deviceId, None)
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Compiled state extraction for agent properties. Working out each value's
+# state key, type conversion and display suffix only depends on the shape of
+# the agent's properties, so StatePlan does it once per schema (see
+# schemaFingerprint in plugin.py) and each poll just walks the compiled steps
+# over the fresh properties.
+
+import logging
+
+################################################################################
+# Globals
+################################################################################
+kUnitSuffixes = {"F": u" °F", "C": u" °C", "pct": u"%"}
+kDirectionUnit = "deg"
+kNoUnit = "-"
+kFloatPlaces = 2
+kDataUnavailable = "- data unavailable -"
+kWindSectorWidth = 22.5
+kWindCardinals = (("N","North"), ("NNE","North Northeast"), ("NE","Northeast"), ("ENE","East Northeast"),
+                  ("E","East"), ("ESE","East Southeast"), ("SE","Southeast"), ("SSE","South Southeast"),
+                  ("S","South"), ("SSW","South Southwest"), ("SW","Southwest"), ("WSW","West Southwest"),
+                  ("W","West"), ("WNW","West Northwest"), ("NW","Northwest"), ("NNW","North Northwest"))
+
+########################################
+def getWindDirectionCardinals(windDirectionsDegrees):
+    # Compass points for a whole sequence of directions (int or float degrees,
+    # any range). Each point covers 22.5 degrees centred on its heading.
+    cardinals = kWindCardinals
+    return [cardinals[int((degrees % 360 + kWindSectorWidth / 2) / kWindSectorWidth) % 16] for degrees in windDirectionsDegrees]
+
+########################################
+def getWindDirectionCardinal(windDirectionDegrees):
+    return getWindDirectionCardinals((windDirectionDegrees,))[0]
+
+########################################
+def formatUiValue(value, places, suffix):
+    if places >= 0 and type(value) is float:
+        return u"%.*f%s" % (places, value, suffix)
+    return u"%s%s" % (value, suffix)
+
+################################################################################
+class StateStep(object):
+    # One device state: where its value lives in the agent properties and how
+    # to convert and display it
+    __slots__ = ("stateKey", "propertyId", "valueIndex", "converter", "typeName", "places", "suffix", "isDirection", "uiTemplate")
+
+    def __init__(self, stateKey, propertyId, valueIndex, typeName, suffix, isDirection):
+        self.stateKey = stateKey
+        self.propertyId = propertyId
+        self.valueIndex = valueIndex
+        self.typeName = typeName
+        self.converter = {"float": float, "int": int}.get(typeName, None)
+        self.places = kFloatPlaces if typeName == "float" else -1
+        self.suffix = suffix
+        self.isDirection = isDirection
+        # Used when the value converted cleanly, which is nearly always
+        suffix = suffix.replace(u"%", u"%%")
+        self.uiTemplate = u"%%.%if%s" % (self.places, suffix) if self.places >= 0 else u"%%s%s" % suffix
+
+################################################################################
+class StatePlan(object):
+    def __init__(self, properties, cardinalFor):
+        # cardinalFor maps degrees to a (short, long) compass point name
+        self.logger = logging.getLogger("Plugin.statePlan")
+        self.cardinalFor = cardinalFor
+        self.steps = []
+        self.stateUnits = {}    # stateKey -> unit, for the deadband filter
+        for propertyId, propertyDict in properties.items():
+            valuesList = propertyDict["values"]
+            # A value without a unit shows the suffix of the one before it
+            suffix = u""
+            isDirection = False
+            for valueIndex, valueDict in enumerate(valuesList):
+                if len(valuesList) == 1:
+                    stateKey = propertyId
+                else:
+                    stateKey = "%s_%s" % (propertyId, valueDict["unit"])
+                if "unit" in valueDict:
+                    unit = valueDict["unit"]
+                    if unit != kNoUnit:
+                        isDirection = unit == kDirectionUnit
+                        suffix = kUnitSuffixes.get(unit, u" %s" % unit)
+                    self.stateUnits[stateKey] = unit
+                self.steps.append(StateStep(stateKey, propertyId, valueIndex, valueDict["type"], suffix, isDirection))
+
+    ########################################
+    def apply(self, properties, deviceName, keyValueList):
+        append = keyValueList.append
+        for step in self.steps:
+            valueDict = properties[step.propertyId]["values"][step.valueIndex]
+            try:
+                newValue = valueDict["value"]
+            except KeyError:
+                self.logger.error("WeatherSnoop device \"%s\" no longer contains data for state %s." % (deviceName, step.stateKey))
+                append({'key': step.stateKey, 'value': kDataUnavailable})
+                continue
+            converter = step.converter
+            if converter is not None:
+                try:
+                    newValue = converter(newValue)
+                except (TypeError, ValueError):
+                    self.logger.debug("WeatherSnoop device \"%s\" reports an incorrect value type for state \"%s\" (can't be converted from string to %s)." % (deviceName, step.stateKey, step.typeName))
+                    suffix = u"°" if step.isDirection else step.suffix
+                    append({'key': step.stateKey, 'value': newValue, 'uiValue': formatUiValue(newValue, -1, suffix), 'decimalPlaces': -1})
+                    continue
+            if step.isDirection and converter is not None:
+                uiValue = formatUiValue(newValue, step.places, u"° (%s)" % self.cardinalFor(newValue)[0])
+            else:
+                uiValue = step.uiTemplate % newValue
+            append({'key': step.stateKey, 'value': newValue, 'uiValue': uiValue, 'decimalPlaces': step.places})
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Keeps the last agent document applied to each device in a JSON file next to
+# the plugin's prefs, so at startup a device can get its state list and last
+# readings back without waiting on WeatherSnoop. The real refresh follows on
+# the normal poll schedule. Writes are batched: record() only marks the cache
+# dirty and save() writes it out (atomically) at most every saveInterval
+# seconds unless forced.
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import json
+except:
+    import simplejson as json
+
+import wsHttp
+
+################################################################################
+# Globals
+################################################################################
+kWarmCacheVersion = 1
+kWarmCacheSaveInterval = 60     # seconds between writes while documents keep changing
+
+################################################################################
+class WarmCache(object):
+    def __init__(self, path, saveInterval=kWarmCacheSaveInterval):
+        self.logger = logging.getLogger("Plugin.warmCache")
+        self.path = path
+        self.saveInterval = saveInterval
+        self.entries = {}   # str(deviceId) -> {"wsAgent": url, "token": token, "document": agent data}
+        self.dirty = False
+        self.lastSave = 0
+        self.lock = threading.Lock()
+
+    ########################################
+    def load(self):
+        try:
+            with open(self.path, "r") as cacheFile:
+                contents = json.load(cacheFile)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            self.logger.warning("Ignoring unreadable startup cache %s: %s" % (self.path, exc))
+            return
+        if not isinstance(contents, dict) or contents.get("version", None) != kWarmCacheVersion:
+            self.logger.debug("Ignoring startup cache from a different plugin version")
+            return
+        with self.lock:
+            self.entries = contents.get("devices", {})
+        self.logger.debug("Loaded startup cache for %i devices" % len(self.entries))
+
+    ########################################
+    def documentFor(self, deviceId, wsAgent):
+        # None unless we have a document from the agent the device uses now
+        with self.lock:
+            entry = self.entries.get(str(deviceId), None)
+        if entry is None or entry.get("wsAgent", None) != wsAgent:
+            return None
+        return wsHttp.AgentDocument(entry["document"], entry["token"])
+
+    ########################################
+    def record(self, deviceId, wsAgent, document):
+        with self.lock:
+            self.entries[str(deviceId)] = {"wsAgent": wsAgent, "token": document.token, "document": document.data}
+            self.dirty = True
+
+    ########################################
+    def save(self, keepDeviceIds, force=False):
+        # keepDeviceIds are the plugin's devices - entries for any others
+        # (deleted devices) are dropped before writing
+        if not self.dirty or (not force and time.time() - self.lastSave < self.saveInterval):
+            return
+        keepKeys = set(str(deviceId) for deviceId in keepDeviceIds)
+        with self.lock:
+            self.entries = dict((key, entry) for key, entry in self.entries.items() if key in keepKeys)
+            contents = json.dumps({"version": kWarmCacheVersion, "devices": self.entries}, separators=(",", ":"))
+            self.dirty = False
+        self.lastSave = time.time()
+        tempPath = self.path + ".tmp"
+        try:
+            with open(tempPath, "w") as cacheFile:
+                cacheFile.write(contents)
+            os.replace(tempPath, self.path)
+        except OSError as exc:
+            self.logger.warning("Couldn't write startup cache %s: %s" % (self.path, exc))
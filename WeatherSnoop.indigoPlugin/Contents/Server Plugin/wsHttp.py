@@ -0,0 +1,426 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# HTTP layer shared by everything in the plugin that talks to a WeatherSnoop
+# server: the poll loop, the device config dialog lists and the startup path.
+# AgentFetcher is the entry point; the other classes are its building blocks.
+
+import hashlib
+import threading
+import time
+import logging
+from concurrent import futures
+from urllib import parse
+
+try:
+    import json
+except:
+    import simplejson as json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+################################################################################
+# Globals
+################################################################################
+kMaxPooledHosts = 8         # WeatherSnoop servers we keep a session open to
+kConnectionsPerHost = 4     # keep-alive sockets retained per server
+kSessionIdleTimeout = 300   # seconds before an unused server session is closed
+kConnectTimeout = 3         # seconds allowed to establish a connection
+kReadTimeout = 10           # seconds allowed between bytes of a reply
+kBreakerFailureThreshold = 3    # consecutive failures before we stop talking to a server
+kBreakerInitialBackoff = 15     # seconds before the first probe of a server that's down
+kBreakerMaxBackoff = 600        # longest wait between probes
+kAddressRetryDelay = 60         # seconds before an mDNS address we couldn't connect to is tried again
+
+################################################################################
+class ServerUnavailableError(Exception):
+    # Raised without touching the network while a server's circuit breaker is open
+    pass
+
+################################################################################
+class DeadlineMissedError(Exception):
+    # Reported by the pollers for fetches still outstanding when a poll cycle's
+    # time budget ran out - the device should be retried, not marked in error
+    pass
+
+########################################
+def isTimeout(exc):
+    # requests raises its own Timeout types, the asyncio poller raises TimeoutError
+    return isinstance(exc, (requests.exceptions.Timeout, TimeoutError))
+
+########################################
+def isConnectFailure(exc):
+    # Couldn't open a connection at all, as opposed to a server that's slow to
+    # reply or dropped a connection that was already open
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        return isinstance(getattr(exc.args[0], "reason", None), NewConnectionError)
+    return False
+
+########################################
+def hostKeyForUrl(url):
+    parts = parse.urlsplit(url)
+    if not parts.hostname:
+        raise ValueError("No host in URL: %s" % url)
+    port = parts.port
+    if not port:
+        port = 443 if parts.scheme == "https" else 80
+    return "%s:%s" % (parts.hostname.lower(), port)
+
+################################################################################
+class SessionPool(object):
+    # One requests.Session per WeatherSnoop server (host:port), so every agent
+    # on that server reuses the same keep-alive connections instead of doing a
+    # fresh name lookup and TCP handshake on each request.
+    def __init__(self, maxHosts=kMaxPooledHosts, connectionsPerHost=kConnectionsPerHost, idleTimeout=kSessionIdleTimeout):
+        self.logger = logging.getLogger("Plugin.wsHttp")
+        self.maxHosts = maxHosts
+        self.connectionsPerHost = connectionsPerHost
+        self.idleTimeout = idleTimeout
+        self.sessions = {}  # hostKey -> [session, lastUsed]
+        self.lock = threading.Lock()
+
+    ########################################
+    def buildSession(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.connectionsPerHost, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    ########################################
+    def sessionForHost(self, hostKey):
+        staleSession = None
+        with self.lock:
+            entry = self.sessions.get(hostKey, None)
+            if entry is None:
+                if len(self.sessions) >= self.maxHosts:
+                    # Make room by dropping the server we talked to least recently
+                    oldestKey = min(self.sessions, key=lambda key: self.sessions[key][1])
+                    staleSession = self.sessions.pop(oldestKey)[0]
+                    self.logger.debug("Session pool full, closing session for %s" % oldestKey)
+                entry = [self.buildSession(), 0]
+                self.sessions[hostKey] = entry
+            entry[1] = time.time()
+            session = entry[0]
+        if staleSession:
+            staleSession.close()
+        return session
+
+    ########################################
+    def get(self, url, **kwargs):
+        hostKey = hostKeyForUrl(url)
+        session = self.sessionForHost(hostKey)
+        try:
+            return session.get(url, **kwargs)
+        except requests.exceptions.RequestException:
+            # The pooled sockets may be dead (server restarted, address changed) -
+            # throw the session away so the next request starts from scratch.
+            self.discard(hostKey, session)
+            raise
+
+    ########################################
+    def discard(self, hostKey, session=None):
+        with self.lock:
+            entry = self.sessions.get(hostKey, None)
+            if entry is None or (session is not None and entry[0] is not session):
+                return
+            del self.sessions[hostKey]
+        self.logger.debug("Discarding session for %s" % hostKey)
+        entry[0].close()
+
+    ########################################
+    def evictIdle(self):
+        cutoff = time.time() - self.idleTimeout
+        with self.lock:
+            idleKeys = [key for key, entry in self.sessions.items() if entry[1] < cutoff]
+            idleSessions = [self.sessions.pop(key)[0] for key in idleKeys]
+        for session in idleSessions:
+            session.close()
+        if idleKeys:
+            self.logger.debug("Closed idle sessions for %s" % idleKeys)
+
+    ########################################
+    def closeAll(self):
+        with self.lock:
+            sessions = [entry[0] for entry in self.sessions.values()]
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+################################################################################
+class AddressCache(object):
+    # Addresses of WeatherSnoop hosts learned from mDNS by the Bonjour browser,
+    # so requests to a .local name can connect straight to the address
+    # instead of going through the system resolver every time. While the
+    # browser is watching a host its addresses stay valid until the daemon
+    # withdraws them; once it stops (release) they last for their record TTL.
+    # An address we couldn't connect to is skipped for a while, then tried again.
+    def __init__(self, retryDelay=kAddressRetryDelay):
+        self.retryDelay = retryDelay
+        self.hosts = {}     # host -> {address: [ttl, expiresAt or None while watched, skip until]}
+        self.lock = threading.Lock()
+
+    ########################################
+    def normalizeHost(self, host):
+        return host.rstrip(".").lower()
+
+    ########################################
+    def add(self, host, address, ttl):
+        with self.lock:
+            self.hosts.setdefault(self.normalizeHost(host), {})[address] = [ttl, None, 0]
+
+    ########################################
+    def remove(self, host, address):
+        with self.lock:
+            addresses = self.hosts.get(self.normalizeHost(host), {})
+            addresses.pop(address, None)
+
+    ########################################
+    def release(self, host):
+        now = time.time()
+        with self.lock:
+            for entry in self.hosts.get(self.normalizeHost(host), {}).values():
+                if entry[1] is None:
+                    entry[1] = now + entry[0]
+
+    ########################################
+    def markFailed(self, host, address):
+        # Called when connecting to a cached address failed. The entry stays, the
+        # browser may still be watching it, and the resolver is used meanwhile.
+        with self.lock:
+            entry = self.hosts.get(self.normalizeHost(host), {}).get(address, None)
+            if entry is not None:
+                entry[2] = time.time() + self.retryDelay
+
+    ########################################
+    def addressFor(self, host):
+        # IPv4 preferred; None when nothing current is known
+        now = time.time()
+        with self.lock:
+            addresses = self.hosts.get(self.normalizeHost(host), None)
+            if not addresses:
+                return None
+            for address, entry in list(addresses.items()):
+                if entry[1] is not None and entry[1] <= now:
+                    del addresses[address]
+            if not addresses:
+                del self.hosts[self.normalizeHost(host)]
+                return None
+            current = sorted((address for address, entry in addresses.items() if entry[2] <= now), key=lambda address: ":" in address)
+        return current[0] if current else None
+
+    ########################################
+    def connectTarget(self, url):
+        # (url to connect to, Host header value or None) - plain http only,
+        # https needs the real name for certificate checks
+        parts = parse.urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            return url, None
+        address = self.addressFor(parts.hostname)
+        if address is None:
+            return url, None
+        netloc = "[%s]" % address if ":" in address else address
+        if parts.port:
+            netloc = "%s:%i" % (netloc, parts.port)
+        return parse.urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment)), parts.netloc
+
+################################################################################
+class AgentDocument(object):
+    # A decoded agent (or sites.json) reply. The token identifies the payload:
+    # two documents with the same token came from byte-identical responses.
+    __slots__ = ("data", "token")
+
+    def __init__(self, data, token):
+        self.data = data
+        self.token = token
+
+################################################################################
+class PayloadTracker(object):
+    # Remembers the validators (ETag/Last-Modified), a hash of the raw body and
+    # the decoded document for each URL, so an unchanged reply - either a 304 or
+    # the same bytes again from a server that doesn't do conditional requests -
+    # hands back the previous document without decoding the JSON again.
+    def __init__(self):
+        self.entries = {}  # url -> [etag, lastModified, AgentDocument]
+        self.lock = threading.Lock()
+
+    ########################################
+    def requestHeaders(self, url):
+        headers = {}
+        with self.lock:
+            entry = self.entries.get(url, None)
+        if entry:
+            if entry[0]:
+                headers["If-None-Match"] = entry[0]
+            if entry[1]:
+                headers["If-Modified-Since"] = entry[1]
+        return headers
+
+    ########################################
+    def documentForResponse(self, url, status, headers, body):
+        # headers must be a case-insensitive mapping or use lowercase names
+        with self.lock:
+            entry = self.entries.get(url, None)
+        if status == 304:
+            if entry is None:
+                raise ValueError("Unexpected 304 reply for %s" % url)
+            return entry[2]
+        token = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if entry is not None and entry[2].token == token:
+            document = entry[2]
+        else:
+            document = AgentDocument(json.loads(body.decode("utf-8")), token)
+        with self.lock:
+            self.entries[url] = [headers.get("etag", None), headers.get("last-modified", None), document]
+        return document
+
+    ########################################
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+################################################################################
+class FetchCoalescer(object):
+    # Collapses concurrent fetches of the same URL into one request: the first
+    # caller does the fetch and everyone else asking for that URL while it's in
+    # flight (poll workers, dialog list methods, device startup) waits on the
+    # same future and gets the same decoded result.
+    def __init__(self, fetchMethod):
+        self.fetchMethod = fetchMethod
+        self.inFlight = {}  # url -> Future
+        self.lock = threading.Lock()
+
+    ########################################
+    def fetch(self, url):
+        with self.lock:
+            future = self.inFlight.get(url, None)
+            isOwner = future is None
+            if isOwner:
+                future = futures.Future()
+                self.inFlight[url] = future
+        if not isOwner:
+            return future.result()
+        try:
+            result = self.fetchMethod(url)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.inFlight[url]
+
+################################################################################
+class CircuitBreakers(object):
+    # Per-server circuit breakers. After enough consecutive failures a server's
+    # breaker opens and requests to it fail immediately with ServerUnavailableError.
+    # Once the backoff has passed a single probe request is let through; if it
+    # fails the backoff doubles, if it succeeds the breaker closes and the server
+    # is reported by popRecovered() so its devices can be cleared in one go.
+    def __init__(self, threshold=kBreakerFailureThreshold, initialBackoff=kBreakerInitialBackoff, maxBackoff=kBreakerMaxBackoff):
+        self.logger = logging.getLogger("Plugin.wsHttp")
+        self.threshold = threshold
+        self.initialBackoff = initialBackoff
+        self.maxBackoff = maxBackoff
+        self.servers = {}   # hostKey -> [consecutiveFailures, retryAt, backoff]
+        self.recovered = set()
+        self.lock = threading.Lock()
+
+    ########################################
+    def allowRequest(self, hostKey):
+        with self.lock:
+            entry = self.servers.get(hostKey, None)
+            if entry is None or entry[0] < self.threshold:
+                return True
+            now = time.time()
+            if now < entry[1]:
+                return False
+            # Let this request through as the probe and hold everyone else off
+            # until it has had time to finish
+            entry[1] = now + entry[2]
+            return True
+
+    ########################################
+    def recordSuccess(self, hostKey):
+        with self.lock:
+            entry = self.servers.pop(hostKey, None)
+            if entry and entry[0] >= self.threshold:
+                self.recovered.add(hostKey)
+                self.logger.info("WeatherSnoop server %s is responding again" % hostKey)
+
+    ########################################
+    def recordFailure(self, hostKey):
+        with self.lock:
+            entry = self.servers.setdefault(hostKey, [0, 0, 0])
+            entry[0] += 1
+            if entry[0] >= self.threshold:
+                entry[2] = min(entry[2] * 2, self.maxBackoff) if entry[2] else self.initialBackoff
+                entry[1] = time.time() + entry[2]
+                self.logger.warning("WeatherSnoop server %s isn't responding - next attempt in %i seconds" % (hostKey, entry[2]))
+
+    ########################################
+    def checkServer(self, hostKey):
+        if not self.allowRequest(hostKey):
+            raise ServerUnavailableError("Not contacting %s until it has had time to recover" % hostKey)
+
+    ########################################
+    def popRecovered(self):
+        with self.lock:
+            recovered = self.recovered
+            self.recovered = set()
+        return recovered
+
+################################################################################
+class AgentFetcher(object):
+    # The one place requests to WeatherSnoop servers are made from. Every
+    # request goes through the server's circuit breaker, a pooled keep-alive
+    # session and the payload tracker, with separate connect and read timeouts,
+    # and concurrent requests for the same URL are coalesced.
+    def __init__(self, connectTimeout=kConnectTimeout, readTimeout=kReadTimeout):
+        self.sessionPool = SessionPool()
+        self.payloadTracker = PayloadTracker()
+        self.circuitBreakers = CircuitBreakers()
+        self.addressCache = AddressCache()
+        self.coalescer = FetchCoalescer(self.requestDocument)
+        # Timeouts from the prefs are strings
+        self.configure(connectTimeout, readTimeout)
+
+    ########################################
+    def configure(self, connectTimeout, readTimeout):
+        self.connectTimeout = float(connectTimeout)
+        self.readTimeout = float(readTimeout)
+
+    ########################################
+    def fetchDocument(self, url):
+        return self.coalescer.fetch(url)
+
+    ########################################
+    def requestDocument(self, url):
+        hostKey = hostKeyForUrl(url)
+        self.circuitBreakers.checkServer(hostKey)
+        headers = self.payloadTracker.requestHeaders(url)
+        requestUrl, hostHeader = self.addressCache.connectTarget(url)
+        if hostHeader:
+            headers["Host"] = hostHeader
+        try:
+            reply = self.sessionPool.get(requestUrl, headers=headers, timeout=(self.connectTimeout, self.readTimeout))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            if hostHeader and isConnectFailure(exc):
+                # The address may be stale - use the resolver for a while
+                self.addressCache.markFailed(parse.urlsplit(url).hostname, parse.urlsplit(requestUrl).hostname)
+            self.circuitBreakers.recordFailure(hostKey)
+            raise
+        self.circuitBreakers.recordSuccess(hostKey)
+        if reply.status_code != 304:
+            reply.raise_for_status()
+        return self.payloadTracker.documentForResponse(url, reply.status_code, reply.headers, reply.content)
+
+    ########################################
+    def close(self):
+        self.sessionPool.closeAll()
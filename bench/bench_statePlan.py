@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Compares statePlan.StatePlan.apply with the per-poll loop updateFromAgentData
+# used before plans were compiled, on an agent with 105 states. Run from the
+# repo root with: python3 bench/bench_statePlan.py
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "WeatherSnoop.indigoPlugin", "Contents", "Server Plugin"))
+
+import statePlan
+
+################################################################################
+# Globals
+################################################################################
+kIterations = 2000
+kRepeats = 5
+
+########################################
+def interpretedKeyValue(dictionary, property, type="string", propKey=None, uiVal=u"", keyValueList=None):
+    # updateWs3KeyValueList as it was
+    places = -1
+    if property in dictionary:
+        try:
+            if type == "float":
+                newValue = float(dictionary[property])
+                places = 2
+            elif type == "int":
+                newValue = int(dictionary[property])
+            else:
+                newValue = dictionary[property]
+        except:
+            newValue = dictionary[property]
+        keyValueList.append({'key':propKey, 'value':newValue, 'uiValue':statePlan.formatUiValue(newValue, places, uiVal), 'decimalPlaces':places})
+    else:
+        keyValueList.append({'key':propKey, 'value':statePlan.kDataUnavailable})
+
+########################################
+def interpretedApply(properties):
+    # The state loop of updateFromAgentData before StatePlan: works out every
+    # state key, unit suffix and conversion again on each poll
+    keyValueList = []
+    stateUnits = {}
+    for stateIdBase, stateDict in properties.items():
+        uiVal = u""
+        valuesList = stateDict["values"]
+        for valueDict in valuesList:
+            if len(valuesList) == 1:
+                stateKey = stateIdBase
+            else:
+                stateKey = "%s_%s" % (stateIdBase, valueDict["unit"])
+            if "unit" in valueDict:
+                unit = valueDict["unit"]
+                if unit != "-":
+                    if unit == "F":
+                        uiVal = u" °F"
+                    elif unit == "C":
+                        uiVal = u" °C"
+                    elif unit == "pct":
+                        uiVal = u"%"
+                    elif unit == "deg":
+                        if valueDict.get("type", "int") == "float":
+                            uiVal = u"° (%s)" % statePlan.getWindDirectionCardinal(float(valueDict.get("value", 0.0)))[0]
+                        else:
+                            uiVal = u"° (%s)" % statePlan.getWindDirectionCardinal(int(valueDict.get("value", 0)))[0]
+                    else:
+                        uiVal = u" %s" % unit
+                stateUnits[stateKey] = unit
+            interpretedKeyValue(valueDict, "value", valueDict["type"], stateKey, uiVal, keyValueList=keyValueList)
+    return keyValueList
+
+########################################
+def sampleProperties():
+    # 15 of each kind of property an agent reports, 105 states in all
+    properties = {}
+    for index in range(15):
+        properties["temperature%i" % index] = {"name": "Temperature", "values": [{"unit": "F", "type": "float", "value": "71.3"},
+                                                                              {"unit": "C", "type": "float", "value": "21.8"}]}
+        properties["humidity%i" % index] = {"name": "Humidity", "values": [{"unit": "pct", "type": "int", "value": "55"}]}
+        properties["windDirection%i" % index] = {"name": "Wind Direction", "values": [{"unit": "deg", "type": "int", "value": "300"}]}
+        properties["windSpeed%i" % index] = {"name": "Wind Speed", "values": [{"unit": "mph", "type": "float", "value": "3.2"},
+                                                                             {"unit": "kph", "type": "float", "value": "5.1"}]}
+        properties["status%i" % index] = {"name": "Status", "values": [{"unit": "-", "type": "string", "value": "ok"}]}
+    return properties
+
+########################################
+def microseconds(function):
+    return min(timeit.repeat(function, number=kIterations, repeat=kRepeats)) / kIterations * 1e6
+
+########################################
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    properties = sampleProperties()
+    plan = statePlan.StatePlan(properties, statePlan.getWindDirectionCardinal)
+
+    def compiledApply(properties):
+        keyValueList = []
+        plan.apply(properties, "bench", keyValueList)
+        return keyValueList
+
+    # Both have to produce the same updates for the timings to mean anything
+    interpreted = interpretedApply(properties)
+    compiled = compiledApply(properties)
+    assert [(update["key"], update["value"]) for update in interpreted] == [(update["key"], update["value"]) for update in compiled]
+
+    interpretedTime = microseconds(lambda: interpretedApply(properties))
+    compiledTime = microseconds(lambda: compiledApply(properties))
+    compileTime = microseconds(lambda: statePlan.StatePlan(properties, statePlan.getWindDirectionCardinal))
+    print("%i states per poll" % len(plan.steps))
+    print("interpreted loop:   %7.1f us per poll" % interpretedTime)
+    print("StatePlan.apply:    %7.1f us per poll (%.0f%% faster)" % (compiledTime, (1 - compiledTime / interpretedTime) * 100))
+    print("building the plan:  %7.1f us once per schema" % compileTime)
+
+if __name__ == "__main__":
+    main()
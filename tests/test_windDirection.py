@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Compass point lookup used for wind direction states. Run from the repo root
+# with: python3 -m unittest discover -s tests
+
+import bisect
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "WeatherSnoop.indigoPlugin", "Contents", "Server Plugin"))
+
+import statePlan
+
+kShortNames = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+# Each point starts 11.25 degrees before its heading, except N which wraps
+kSectorStarts = [11.25 + 22.5 * index for index in range(16)]
+
+########################################
+def expectedShortName(degrees):
+    return kShortNames[bisect.bisect_right(kSectorStarts, degrees) % 16]
+
+################################################################################
+class WindDirectionTests(unittest.TestCase):
+    def testEveryTenthOfADegree(self):
+        directions = [tenths / 10.0 for tenths in range(3600)]
+        cardinals = statePlan.getWindDirectionCardinals(directions)
+        for degrees, cardinal in zip(directions, cardinals):
+            self.assertEqual(cardinal[0], expectedShortName(degrees), "%.1f degrees" % degrees)
+
+    ########################################
+    def testWholeDegrees(self):
+        for degrees in range(360):
+            self.assertEqual(statePlan.getWindDirectionCardinal(degrees)[0], expectedShortName(degrees), "%i degrees" % degrees)
+
+    ########################################
+    def testSectorBoundaries(self):
+        self.assertEqual(statePlan.getWindDirectionCardinal(11.24)[0], "N")
+        self.assertEqual(statePlan.getWindDirectionCardinal(11.25)[0], "NNE")
+        self.assertEqual(statePlan.getWindDirectionCardinal(33.75)[0], "NE")
+        self.assertEqual(statePlan.getWindDirectionCardinal(348.74)[0], "NNW")
+        self.assertEqual(statePlan.getWindDirectionCardinal(348.75)[0], "N")
+        self.assertEqual(statePlan.getWindDirectionCardinal(359.99)[0], "N")
+
+    ########################################
+    def testOutOfRangeDegrees(self):
+        self.assertEqual(statePlan.getWindDirectionCardinal(-11.25)[0], "N")
+        self.assertEqual(statePlan.getWindDirectionCardinal(-11.26)[0], "NNW")
+        self.assertEqual(statePlan.getWindDirectionCardinal(-90)[0], "W")
+        self.assertEqual(statePlan.getWindDirectionCardinal(360)[0], "N")
+        self.assertEqual(statePlan.getWindDirectionCardinal(371.25)[0], "NNE")
+        self.assertEqual(statePlan.getWindDirectionCardinal(450)[0], "E")
+        self.assertEqual(statePlan.getWindDirectionCardinal(720.5)[0], "N")
+
+    ########################################
+    def testLongNames(self):
+        self.assertEqual(statePlan.getWindDirectionCardinal(0), ("N", "North"))
+        self.assertEqual(statePlan.getWindDirectionCardinal(202.5), ("SSW", "South Southwest"))
+
+if __name__ == "__main__":
+    unittest.main()